@@ -1,40 +1,681 @@
 import os
 import json
+import base64
 import datetime
 
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_cors import CORS
-from models import setup_db, Actor, Movie
-from auth import AuthError, requires_auth
+from sqlalchemy import func, and_, or_, DateTime
+from models import setup_db, db, Actor, Movie, movie_actors, insert_many, \
+    insert_if_absent, update_row, delete_row, set_cast, get_cast_ids, \
+    format_cast, get_versions, get_deleted_ids, database_path
+from search import search, search_terms
+from serialization import init_json, jsonify, jsonify_fragments, \
+    dumps_bytes
+from cache import init_response_cache, cached_response, \
+    conditional_response, row_encoder
+from replicas import init_read_replicas, use_primary
+from sharding import init_shards, shard_for, each_shard, each_shard_iter, \
+    each_group, merge, fan_out, sort_key, load_casts
+from events import init_change_feed, stream_events, read_backlog, \
+    was_pruned, SSE_MIMETYPE
+from auth import AuthError, requires_auth, jwks_cache, \
+    JWKS_BACKGROUND_REFRESH
+
+PAGE_SIZE_DEFAULT = int(os.getenv('PAGE_SIZE_DEFAULT', 20))
+PAGE_SIZE_MAX = int(os.getenv('PAGE_SIZE_MAX', 100))
+UNPAGINATED_ROW_CAP = int(os.getenv('UNPAGINATED_ROW_CAP', 1000))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 500))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+MOVIE_EXPANDS = frozenset(['cast'])
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 10000))
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 500))
+
+
+# Pagination Helpers
+def encode_cursor(position):
+    # Cursors are opaque to clients; they carry the last seen sort key
+    raw = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padding = '=' * (-len(cursor) % 4)
+    position = json.loads(base64.urlsafe_b64decode(cursor + padding))
+
+    if not isinstance(position, dict) or \
+            not isinstance(position.get('id'), int):
+        raise ValueError('Malformed cursor.')
+
+    return position
+
+
+def get_page_args():
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+
+    # Unpaginated callers get the whole table up to a hard row cap
+    if limit is None and cursor is None:
+        return UNPAGINATED_ROW_CAP, None
+
+    try:
+        limit = PAGE_SIZE_DEFAULT if limit is None else int(limit)
+        position = decode_cursor(cursor) if cursor else None
+
+    except (ValueError, TypeError):
+        abort(400)
+
+    if limit < 1 or limit > PAGE_SIZE_MAX:
+        abort(400)
+
+    return limit, position
+
+
+def split_page(rows, limit, position_of):
+    # Pages are fetched with one extra row to tell if another page follows
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(position_of(rows[-1]))
+
+    return rows, next_cursor
+
+
+# Filtering and Sorting Helpers
+def get_filter_args(model, fields):
+    # name=value for equality, name_min / name_max for inclusive ranges
+    filters = []
+
+    try:
+        for name, parse in fields.items():
+            column = getattr(model, name)
+
+            if name in request.args:
+                filters.append(column == parse(request.args[name]))
+
+            if name + '_min' in request.args:
+                filters.append(column >= parse(request.args[name + '_min']))
+
+            if name + '_max' in request.args:
+                filters.append(column <= parse(request.args[name + '_max']))
+
+    except ValueError:
+        abort(400)
+
+    return filters
+
+
+def get_sort_args(fields):
+    # sort=gender,-age; id is always the final tie-breaker
+    keys = []
+    sort = request.args.get('sort')
+
+    if sort:
+        for key in sort.split(','):
+            name = key.strip().lstrip('-')
+
+            if name not in fields and name != 'id' or \
+                    name in [known for known, descending in keys]:
+                abort(400)
+
+            keys.append((name, key.strip().startswith('-')))
+
+    if 'id' not in [name for name, descending in keys]:
+        keys.append(('id', False))
+
+    return keys
+
+
+def sort_signature(keys):
+    return ','.join(('-' if descending else '') + name
+                    for name, descending in keys)
+
+
+def position_of(row, keys):
+    values = []
+    for name, descending in keys:
+        value = getattr(row, name)
+        values.append(value.isoformat()
+                      if isinstance(value, datetime.datetime) else value)
+
+    return {'id': row.id, 'sort': sort_signature(keys), 'values': values}
+
+
+def get_seek_values(model, keys, position):
+    # A cursor is only valid for the sort order that produced it
+    if position is None:
+        return None
+
+    values = position.get('values', [position['id']])
+
+    if position.get('sort', 'id') != sort_signature(keys) or \
+            not isinstance(values, list) or len(values) != len(keys):
+        abort(400)
+
+    try:
+        return [datetime.datetime.fromisoformat(value)
+                if isinstance(getattr(model, name).type, DateTime) and
+                value is not None else value
+                for (name, descending), value in zip(keys, values)]
+
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def get_list_args(model, fields):
+    limit, position = get_page_args()
+    keys = get_sort_args(fields)
+
+    return limit, get_filter_args(model, fields), keys, \
+        get_seek_values(model, keys, position)
+
+
+def build_list_query(model, filters=(), keys=(('id', False),), after=None,
+                     selected=None):
+    # selected columns are read as plain rows instead of ORM objects
+    query = model.query if selected is None \
+        else db.session.query(*selected)
+
+    columns = [(getattr(model, name), descending) for name, descending in keys]
+    query = query.filter(*filters).order_by(
+        *[column.desc() if descending else column
+          for column, descending in columns])
+
+    # Seek past the last seen sort key instead of using OFFSET
+    if after is not None:
+        clauses = []
+        for index, (column, descending) in enumerate(columns):
+            ties = [previous == value for (previous, ignored), value
+                    in zip(columns[:index], after[:index])]
+            step = column < after[index] if descending \
+                else column > after[index]
+            clauses.append(and_(*ties, step))
+
+        query = query.filter(or_(*clauses))
+
+    return query
+
+
+def get_page(model, limit, filters=(), keys=(('id', False),), after=None,
+             selected=None):
+    # Every shard reads a full page; the merge keeps the first limit + 1
+    rows = fan_out(lambda: build_list_query(
+        model, filters, keys, after, selected).limit(limit + 1).all(),
+        sort_key(keys))
+
+    return split_page(rows[:limit + 1], limit,
+                      lambda row: position_of(row, keys))
+
+
+# Delta Sync Helpers
+def get_since():
+    since = request.args.get('since')
+
+    if since is None:
+        return None
+
+    try:
+        since = int(since)
+
+    except ValueError:
+        abort(400)
+
+    if since < 0:
+        abort(400)
+
+    return since
+
+
+def get_delta_page(model, fields, since, selected=None):
+    # Changed rows in version order; filters and sort do not apply
+    names = set(fields) | {name + suffix for name in fields
+                           for suffix in ('_min', '_max')} | {'sort'}
+    if names & set(request.args):
+        abort(400)
+
+    limit, position = get_page_args()
+    keys = [('row_version', False), ('id', False)]
+
+    # The first page fixes the high-water mark; later pages carry it along
+    if position is None:
+        version = get_versions(model.__tablename__)[model.__tablename__]
+        deleted = get_deleted_ids(model.__tablename__, since)
+
+    elif isinstance(position.get('version'), int):
+        version = position['version']
+        deleted = []
+
+    else:
+        abort(400)
+
+    after = get_seek_values(model, keys, position)
+    columns = get_field_columns(model, selected, keys)
+    rows = fan_out(lambda: build_list_query(
+        model, [model.row_version > since], keys, after, columns)
+        .limit(limit + 1).all(), sort_key(keys))
+
+    rows, next_cursor = split_page(
+        rows[:limit + 1], limit,
+        lambda row: dict(position_of(row, keys), version=version))
+
+    return rows, deleted, version, next_cursor
+
+
+def get_release_date_position(position):
+    # Filmography cursors carry the release date and id of the last movie
+    if position is None:
+        return None
+
+    try:
+        return datetime.datetime.fromisoformat(position['release_date']), \
+            position['id']
+
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+
+def get_filmography_page(actor_id, limit, after=None):
+    def read_page():
+        # Walk the (actor_id, movie_id) index, then sort the actor's movies
+        query = Movie.query \
+            .join(movie_actors, movie_actors.c.movie_id == Movie.id) \
+            .filter(movie_actors.c.actor_id == actor_id) \
+            .order_by(Movie.release_date, Movie.id)
+
+        if after is not None:
+            release_date, movie_id = after
+            query = query.filter(or_(
+                Movie.release_date > release_date,
+                and_(Movie.release_date == release_date,
+                     Movie.id > movie_id)))
+
+        return query.limit(limit + 1).all()
+
+    movies = fan_out(read_page, sort_key(
+        (('release_date', False), ('id', False))))[:limit + 1]
+
+    return split_page(load_casts(movies), limit,
+                      lambda movie: {
+                          'release_date': movie.release_date.isoformat(),
+                          'id': movie.id})
+
+
+def count_filmography(actor_id):
+    return sum(each_shard(lambda: db.session.query(func.count())
+                          .select_from(movie_actors)
+                          .filter(movie_actors.c.actor_id == actor_id)
+                          .scalar()))
+
+
+def count_rows(model, filters=()):
+    return sum(each_shard(lambda: db.session.query(func.count(model.id))
+                          .filter(*filters).scalar()))
+
+
+# Sparse Fieldset Helpers
+def get_fields_args(allowed):
+    # fields=id,name returns only those columns
+    fields = request.args.get('fields')
+
+    if fields is None:
+        return None
+
+    names = [name.strip() for name in fields.split(',')]
+
+    if not all(name in allowed for name in names) or \
+            len(set(names)) != len(names):
+        abort(400)
+
+    return names
+
+
+def get_field_columns(model, fields, keys):
+    # The sort keys are read too so the next cursor can be built
+    if fields is None:
+        return None
+
+    names = fields + [name for name, descending in keys if name not in fields]
+
+    return [getattr(model, name) for name in names]
+
+
+def field_formatter(fields, allowed):
+    pairs = [(name, allowed[name]) for name in fields]
+
+    return lambda row: {key: getattr(row, name) for name, key in pairs}
+
+
+def get_encoder(table, formatter, fields, version_of=None, variant=''):
+    # Full rows are reused from the fragment cache; sparse rows are cheap
+    if fields is not None:
+        return lambda row: dumps_bytes(formatter(row))
+
+    return row_encoder(table, formatter, version_of, variant)
+
+
+def cast_version(movie):
+    # Expanded movies embed their actors, so actor changes count too
+    return movie.row_version, tuple(actor.row_version
+                                    for actor in movie.actors)
+
+
+def get_expand_args(allowed):
+    # Comma separated list of related objects to embed in the response
+    expand = request.args.get('expand')
+
+    if not expand:
+        return frozenset()
+
+    fields = frozenset(field.strip() for field in expand.split(','))
+
+    if not fields <= allowed:
+        abort(400)
+
+    return fields
+
+
+# Field Parsers
+def parse_text(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('Text fields must be non-empty strings.')
+
+    return value
+
+
+def parse_age(value):
+    try:
+        age = int(value)
+
+    except (TypeError, ValueError):
+        raise ValueError('Age must be a number.')
+
+    if age <= 0:
+        raise ValueError('Age must be positive.')
+
+    return age
+
+
+def parse_release_date(value):
+    try:
+        year, month, day = (int(part) for part in value.split('-'))
+        return datetime.datetime(year, month, day)
+
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError('Release date must use the YYYY-MM-DD format.')
+
+
+# Writable columns and their parsers; anything else is rejected
+ACTOR_FIELDS = {'name': parse_text, 'age': parse_age, 'gender': parse_text}
+MOVIE_FIELDS = {'title': parse_text, 'release_date': parse_release_date}
+
+# Columns selectable with fields= and their keys in the response
+ACTOR_COLUMNS = {'id': 'id', 'name': 'name', 'age': 'age', 'gender': 'gender'}
+MOVIE_COLUMNS = {'id': 'id', 'title': 'title', 'release_date': 'release date'}
+
+
+def parse_record(record, fields):
+    # Every field is required when creating a record
+    if not isinstance(record, dict):
+        raise ValueError('Each record must be an object.')
+
+    missing = [name for name in fields if not record.get(name)]
+
+    if missing:
+        raise ValueError('Missing fields: {}.'.format(', '.join(missing)))
+
+    return {name: parse(record[name]) for name, parse in fields.items()}
+
+
+def get_changes(fields, extra=()):
+    # Validate a PATCH body against the whitelist before touching the DB
+    body = request.get_json()
+
+    if not isinstance(body, dict) or \
+            not set(body) <= set(fields) | set(extra):
+        abort(400)
+
+    try:
+        return {name: fields[name](value)
+                for name, value in body.items() if name in fields}
+
+    except ValueError:
+        abort(400)
+
+
+# Bulk Insert Helpers
+def bulk_insert(model, records, fields, id_key):
+    # Validate every record before writing anything
+    results = []
+    rows = []
+
+    for index, record in enumerate(records):
+        try:
+            rows.append((index, parse_record(record, fields)))
+            results.append(None)
+
+        except ValueError as error:
+            results.append({
+                'index': index,
+                'success': False,
+                'error': 400,
+                'message': str(error)
+            })
+
+    # Insert the valid records with one statement and commit per chunk;
+    # insert_many says how each database gets the new ids back
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        chunk = rows[start:start + BULK_CHUNK_SIZE]
+
+        try:
+            ids = insert_many(model, [row for index, row in chunk])
+
+        except Exception:
+            db.session.rollback()
+            ids = [None] * len(chunk)
+
+        for (index, row), row_id in zip(chunk, ids):
+            if row_id is None:
+                results[index] = {
+                    'index': index,
+                    'success': False,
+                    'error': 422,
+                    'message': 'Unprocessable Entity'
+                }
+
+            else:
+                results[index] = {
+                    'index': index,
+                    'success': True,
+                    id_key: row_id
+                }
+
+    return results
+
+
+def get_bulk_records():
+    records = request.get_json()
+
+    if not isinstance(records, list) or not records or \
+            len(records) > BULK_MAX_ITEMS:
+        abort(400)
+
+    return records
+
+
+def get_cast(actor_ids):
+    # Check a list of actor ids in one query; unknown ids are rejected
+    if not isinstance(actor_ids, list):
+        abort(422)
+
+    try:
+        actor_ids = {int(actor_id) for actor_id in actor_ids}
+
+    except (TypeError, ValueError):
+        abort(422)
+
+    if not actor_ids:
+        return []
+
+    found = sum(each_group(actor_ids, lambda ids: db.session.query(Actor.id)
+                           .filter(Actor.id.in_(ids)).count()))
+
+    if found != len(actor_ids):
+        abort(422)
+
+    return sorted(actor_ids)
+
+
+# Search Helpers
+def get_search_args():
+    query = request.args.get('q', '')
+    limit, position = get_page_args()
+
+    # Search results default to a normal page rather than the row cap
+    if 'limit' not in request.args:
+        limit = PAGE_SIZE_DEFAULT
+
+    if not search_terms(query):
+        abort(400)
+
+    after = None
+    if position is not None:
+        score = position.get('score')
+
+        if not isinstance(score, (int, float)):
+            abort(400)
+
+        after = (score, position['id'])
+
+    return query, limit, after
+
+
+def get_search_page(model, query, limit, after=None):
+    # Scores come from each shard's own index statistics
+    results = fan_out(lambda: search(model, query, limit + 1, after),
+                      lambda result: (result[0], result[1].id))
+
+    results, next_cursor = split_page(
+        results[:limit + 1], limit,
+        lambda result: {'id': result[1].id, 'score': result[0]})
+
+    return [row for score, row in results], next_cursor
+
+
+# Streaming Helpers
+def wants_stream():
+    if request.args.get('stream') == '1':
+        return True
+
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def stream_rows(model, filters=(), keys=(('id', False),), after=None,
+                encode=None, selected=None):
+    def encode_chunk(rows):
+        # Sharded movies get their casts one chunk at a time
+        if model is Movie and selected is None:
+            load_casts(rows)
+
+        return b''.join((dumps_bytes(row.format()) if encode is None
+                         else encode(row)) + b'\n' for row in rows)
+
+    def generate():
+        # yield_per fetches through a server-side cursor in fixed chunks,
+        # one cursor per shard
+        rows = merge(each_shard_iter(lambda: build_list_query(
+            model, filters, keys, after, selected)
+            .yield_per(STREAM_CHUNK_SIZE)), sort_key(keys))
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield encode_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            yield encode_chunk(chunk)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
 
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
-    setup_db(app)
+
+    if test_config is not None:
+        app.config.update(test_config)
+
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+    init_shards(app)
+    init_read_replicas(app)
     CORS(app)
+    init_json(app)
+    init_response_cache(app)
+    init_change_feed(app)
+
+    # Keep the signing keys warm so requests never wait on Auth0; started
+    # with the first request so creating the app stays free of network I/O
+    if JWKS_BACKGROUND_REFRESH:
+        app.before_first_request(jwks_cache.start_background_refresh)
 
     # GET Routes
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional_response('actors', skip=wants_stream)
+    @cached_response('actors', skip=wants_stream)
     def get_actors(payload):
+        since = get_since()
+        fields = get_fields_args(ACTOR_COLUMNS)
+        formatter = Actor.format if fields is None \
+            else field_formatter(fields, ACTOR_COLUMNS)
+        encode = get_encoder('actors', formatter, fields)
+
+        # Sync clients only fetch what changed after their last version
+        if since is not None:
+            actorList, deleted, version, next_cursor = get_delta_page(
+                Actor, ACTOR_FIELDS, since, fields)
+
+            return jsonify_fragments(
+                'actors', [encode(actor) for actor in actorList],
+                success=True,
+                deleted=deleted,
+                version=version,
+                next_cursor=next_cursor
+            ), 200
+
+        limit, filters, keys, after = get_list_args(Actor, ACTOR_FIELDS)
+        selected = get_field_columns(Actor, fields, keys)
+
+        # Batch consumers can stream the whole table as NDJSON
+        if wants_stream():
+            return stream_rows(Actor, filters, keys, after, encode, selected)
+
         try:
-            # Get a list of all actors in DB
-            actorList = Actor.query.all()
+            # Get one page of actors and the total count from the DB
+            actorList, next_cursor = get_page(
+                Actor, limit, filters, keys, after, selected)
+            actorCount = count_rows(Actor, filters)
 
             # Return the list of actors if at least one exists
-            if len(actorList) > 0:
-                return jsonify({
-                    'success': True,
-                    'actors': [actor.format() for actor in actorList],
-                    'actor_count': len(actorList)
-                }), 200
+            if actorCount > 0:
+                return jsonify_fragments(
+                    'actors', [encode(actor) for actor in actorList],
+                    success=True,
+                    actor_count=actorCount,
+                    next_cursor=next_cursor
+                ), 200
 
             else:
                 return jsonify({
                     'success': False,
                     'actors': [],
                     'actor_count': 0,
+                    'next_cursor': None,
                     'message': 'No actors found.'
                 }), 200
 
@@ -44,30 +685,213 @@ def create_app(test_config=None):
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional_response('movies', 'actors', skip=wants_stream)
+    @cached_response('movies', 'actors', skip=wants_stream)
     def get_movies(payload):
+        since = get_since()
+        expand = get_expand_args(MOVIE_EXPANDS)
+        fields = get_fields_args(MOVIE_COLUMNS)
+
+        # The cast is not a column, so it cannot be combined with fields
+        if fields is not None and expand:
+            abort(400)
+
+        formatter = (lambda movie: movie.format(expand)) if fields is None \
+            else field_formatter(fields, MOVIE_COLUMNS)
+        encode = get_encoder('movies', formatter, fields, cast_version,
+                             'cast') if 'cast' in expand \
+            else get_encoder('movies', formatter, fields)
+
+        # Sync clients only fetch what changed after their last version
+        if since is not None:
+            movieList, deleted, version, next_cursor = get_delta_page(
+                Movie, MOVIE_FIELDS, since, fields)
+            if fields is None:
+                load_casts(movieList)
+
+            return jsonify_fragments(
+                'movies', [encode(movie) for movie in movieList],
+                success=True,
+                deleted=deleted,
+                version=version,
+                next_cursor=next_cursor
+            ), 200
+
+        limit, filters, keys, after = get_list_args(Movie, MOVIE_FIELDS)
+        selected = get_field_columns(Movie, fields, keys)
+
+        # Batch consumers can stream the whole table as NDJSON
+        if wants_stream():
+            return stream_rows(Movie, filters, keys, after, encode, selected)
+
         try:
-            # Get a list of all movies in DB
-            movieList = Movie.query.all()
+            # Get one page of movies and the total count from the DB
+            movieList, next_cursor = get_page(
+                Movie, limit, filters, keys, after, selected)
+            movieCount = count_rows(Movie, filters)
+            if fields is None:
+                load_casts(movieList)
 
             # Return the list of movies if at least one exists
-            if len(movieList) > 0:
-                return jsonify({
-                    'success': True,
-                    'movies': [movie.format() for movie in movieList],
-                    'movie_count': len(movieList)
-                }), 200
+            if movieCount > 0:
+                return jsonify_fragments(
+                    'movies', [encode(movie) for movie in movieList],
+                    success=True,
+                    movie_count=movieCount,
+                    next_cursor=next_cursor
+                ), 200
 
             else:
                 return jsonify({
                     'success': False,
                     'movies': [],
                     'movie_count': 0,
+                    'next_cursor': None,
                     'message': 'No movies found.'
                 }), 200
 
         except Exception:
             # Return Unprocessable Entity error if the Try block fails
             abort(422)
+
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional_response('actors', 'movies')
+    def get_actor_movies(payload, id):
+        limit, position = get_page_args()
+        after = get_release_date_position(position)
+        expand = get_expand_args(MOVIE_EXPANDS)
+
+        # Return Not Found error if the actor does not exist
+        with shard_for(id):
+            if Actor.query.get(id) is None:
+                abort(404)
+
+        try:
+            # Get one page of the actor's movies, oldest release first
+            movieList, next_cursor = get_filmography_page(id, limit, after)
+
+            return jsonify({
+                'success': True,
+                'actor_id': id,
+                'movies': [movie.format(expand) for movie in movieList],
+                'movie_count': count_filmography(id),
+                'next_cursor': next_cursor
+            }), 200
+
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+    @app.route('/actors/search', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional_response('actors')
+    def search_actors(payload):
+        query, limit, after = get_search_args()
+
+        try:
+            # Get one page of actors ranked by how well their name matches
+            actorList, next_cursor = get_search_page(
+                Actor, query, limit, after)
+
+            return jsonify({
+                'success': True,
+                'actors': [actor.format() for actor in actorList],
+                'next_cursor': next_cursor
+            }), 200
+
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+    @app.route('/movies/search', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional_response('movies', 'actors')
+    def search_movies(payload):
+        query, limit, after = get_search_args()
+
+        try:
+            # Get one page of movies ranked by how well their title matches
+            movieList, next_cursor = get_search_page(
+                Movie, query, limit, after)
+            load_casts(movieList)
+
+            return jsonify({
+                'success': True,
+                'movies': [movie.format() for movie in movieList],
+                'next_cursor': next_cursor
+            }), 200
+
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+    @app.route('/movies/<int:id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional_response('movies', 'actors')
+    def get_movie(payload, id):
+        expand = get_expand_args(MOVIE_EXPANDS)
+
+        # Get movie details for the matching ID
+        with shard_for(id):
+            movie = Movie.query.get(id)
+
+        # Return Not Found error if the movie does not exist
+        if movie is None:
+            abort(404)
+
+        load_casts([movie])
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format(expand)
+        }), 200
+
+    @app.route('/events', methods=['GET'])
+    @use_primary
+    @requires_auth('get:movies')
+    def get_events(payload):
+        # Resuming clients send the id of the last event they received
+        last_event_id = request.headers.get('Last-Event-ID',
+                                            request.args.get('last_event_id'))
+
+        try:
+            last_event_id = None if last_event_id is None \
+                else int(last_event_id)
+
+        except ValueError:
+            abort(400)
+
+        permissions = payload.get('permissions', [])
+        tables = {'movies'} | ({'actors'} if 'get:actors' in permissions
+                               else set())
+
+        feed = app.extensions['change_feed']
+        subscriber, dispatched_id = feed.subscribe(tables)
+
+        # Anything newer than dispatched_id arrives through the subscriber
+        backlog = []
+        reset = False
+        try:
+            if last_event_id is not None and last_event_id < dispatched_id:
+                reset = was_pruned(last_event_id)
+                backlog = read_backlog(last_event_id, dispatched_id)
+
+        except Exception:
+            feed.unsubscribe(subscriber)
+            abort(422)
+
+        # The stream outlives the request; do not hold a connection open
+        db.session.remove()
+
+        response = Response(
+            stream_events(feed, subscriber, backlog,
+                          dispatched_id if last_event_id is None
+                          else last_event_id, reset),
+            mimetype=SSE_MIMETYPE)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
     # END GET Routes
 
     # POST Routes
@@ -146,220 +970,254 @@ def create_app(test_config=None):
         except Exception:
             # Return Unprocessable Entity error if the Try block fails
             abort(422)
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_actors_bulk(payload):
+        records = get_bulk_records()
+
+        try:
+            results = bulk_insert(Actor, records, ACTOR_FIELDS,
+                                  'actor_id')
+            created = sum(1 for result in results if result['success'])
+
+            return jsonify({
+                'success': created == len(results),
+                'created': created,
+                'results': results
+            }), 200
+
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_movies_bulk(payload):
+        records = get_bulk_records()
+
+        try:
+            results = bulk_insert(Movie, records, MOVIE_FIELDS,
+                                  'movie_id')
+            created = sum(1 for result in results if result['success'])
+
+            return jsonify({
+                'success': created == len(results),
+                'created': created,
+                'results': results
+            }), 200
+
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
     # END POST Routes
 
     # PATCH Routes
     @app.route('/actors/<int:id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def patch_actors(payload, id):
-        # Get actor details for the matching ID
-        actor = Actor.query.get(id)
+        # Reject unknown attributes and invalid values before the DB
+        changes = get_changes(ACTOR_FIELDS)
 
         try:
-            # Loop through updated keys and update the values
-            for attribute, value in request.json.items():
-                setattr(actor, attribute, value)
-
-            # Push updated values to the DB
-            actor.update()
-
-            # Return all actor details after update is completed
-            return jsonify({
-                'success': True,
-                'actor_id': actor.id,
-                'actor_name': actor.name,
-                'actor_age': actor.age,
-                'actor_gender': actor.gender
-            }), 200
+            # Update the actor and read it back in one statement
+            with shard_for(id):
+                actor = update_row(Actor, id, changes)
 
         except Exception:
-            # Return Not Found error if the Try block fails
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+        # Return Not Found error if no actor has the matching ID
+        if actor is None:
             abort(404)
 
+        # Return all actor details after update is completed
+        return jsonify({
+            'success': True,
+            'actor_id': actor.id,
+            'actor_name': actor.name,
+            'actor_age': actor.age,
+            'actor_gender': actor.gender
+        }), 200
+
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def patch_movies(payload, id):
-        # Get movie details for the matching ID
-        movie = Movie.query.get(id)
+        # Reject unknown attributes and invalid values before the DB
+        changes = get_changes(MOVIE_FIELDS, extra=('cast',))
+
+        # Look up the new cast members before touching the movie
+        castIds = None
+        if 'cast' in request.json:
+            castIds = get_cast(request.json['cast'])
 
         try:
-            # Loop through updated keys and update the values
-            for attribute, value in request.json.items():
-                # If actors attribute is found, reference the actors DB table
-                if attribute == 'cast':
-                    setattr(
-                        movie,
-                        attribute,
-                        ",".join(str(actor_id) for actor_id in value))
+            # Update the movie and read it back in one statement; a new
+            # cast shares the movie's single version stamp and event
+            with shard_for(id):
+                movie = update_row(Movie, id, changes, commit=False,
+                                   touch=castIds is not None)
 
-                else:
-                    setattr(movie, attribute, value)
+                if movie is not None:
+                    if castIds is None:
+                        castIds = get_cast_ids(id)
 
-            # Push updated values to the DB
-            movie.update()
+                    else:
+                        set_cast(id, castIds)
 
-            return jsonify({
-                'success': True,
-                'movie_id': movie.id,
-                'movie_title': movie.title,
-                'movie_release_date': movie.release_date,
-                'movie_cast': movie.cast
-            }), 200
+                    db.session.commit()
 
         except Exception:
-            # Return Not Found error if the Try block fails
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+        # Return Not Found error if no movie has the matching ID
+        if movie is None:
             abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie_id': movie.id,
+            'movie_title': movie.title,
+            'movie_release_date': movie.release_date,
+            'movie_cast': format_cast(castIds)
+        }), 200
     # END PATCH Routes
 
     # DELETE Routes
     @app.route('/actors/<int:id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actors(payload, id):
-        # Get actor details for the matching ID
-        actor = Actor.query.get(id)
-
         try:
-            # Delete entry from the DB
-            actor.delete()
-
-            return jsonify({
-                'success': True,
-                'actor_id': id
-            }), 200
+            # Delete entry from the DB without loading it first
+            with shard_for(id):
+                deleted = delete_row(Actor, id)
 
         except Exception:
-            # Return Not Found error if the Try block fails
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+        # Return Not Found error if no actor has the matching ID
+        if not deleted:
             abort(404)
 
+        return jsonify({
+            'success': True,
+            'actor_id': id
+        }), 200
+
     @app.route('/movies/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movies(payload, id):
-        # Get movie details for the matching ID
-        movie = Movie.query.get(id)
-
         try:
-            # Delete entry from the DB
-            movie.delete()
-
-            return jsonify({
-                'success': True,
-                'movie_id': id
-            }), 200
+            # Delete entry from the DB without loading it first
+            with shard_for(id):
+                deleted = delete_row(Movie, id)
 
         except Exception:
-            # Return Not Found error if the Try block fails
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+        # Return Not Found error if no movie has the matching ID
+        if not deleted:
             abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie_id': id
+        }), 200
     # END DELETE Routes
 
     # Testing Routes for Postman
     @app.route('/actors/<int:id>', methods=['POST'])
     @requires_auth('post:actors')
     def add_actor_with_id(payload, id):
-        body = request.get_json()
-
-        # Get actor details for the matching ID if it exists
-        actor_check = Actor.query.get(id)
-
-        if actor_check is None:
-
-            try:
-                forced_id = id
-                name = body.get('name', None)
-                age = int(body.get('age', 0))
-                gender = body.get('gender', None)
+        try:
+            actor = parse_record(request.get_json(), ACTOR_FIELDS)
 
-                if name and age > 0 and gender:
-                    actor = Actor(
-                        name=name,
-                        age=age,
-                        gender=gender)
-                    actor.id = forced_id
+        except ValueError:
+            # Same status as the collection route for the same bad body
+            abort(422)
 
-                    try:
-                        actor.insert()
+        try:
+            # Insert atomically; concurrent writers of the same ID can't race
+            with shard_for(id):
+                created = insert_if_absent(Actor, dict(actor, id=id))
 
-                    except Exception:
-                        abort(422)
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
 
-                    return jsonify({
-                        'success': True,
-                        'actor_id': actor.id,
-                        'actor_name': actor.name,
-                        'actor_age': actor.age,
-                        'actor_gender': actor.gender
-                    })
+        if created:
+            return jsonify({
+                'success': True,
+                'actor_id': id,
+                'actor_name': actor['name'],
+                'actor_age': actor['age'],
+                'actor_gender': actor['gender']
+            })
 
-                else:
-                    abort(400)
+        # Get actor details for the existing ID
+        with shard_for(id):
+            actor_check = Actor.query.get(id)
 
-            except Exception:
-                # Return Unprocessable Entity error if the Try block fails
-                abort(422)
+        if actor_check is None:
+            abort(422)
 
-        else:
-            return jsonify({
-                        'success': False,
-                        'actor_id': actor_check.id,
-                        'actor_name': actor_check.name,
-                        'actor_age': actor_check.age,
-                        'actor_gender': actor_check.gender,
-                        'message': 'An actor with that ID alread exists.'
-                    })
+        return jsonify({
+                    'success': False,
+                    'actor_id': actor_check.id,
+                    'actor_name': actor_check.name,
+                    'actor_age': actor_check.age,
+                    'actor_gender': actor_check.gender,
+                    'message': 'An actor with that ID alread exists.'
+                })
 
     @app.route('/movies/<int:id>', methods=['POST'])
     @requires_auth('post:movies')
     def add_movie_with_id(payload, id):
-        body = request.get_json()
+        try:
+            movie = parse_record(request.get_json(), MOVIE_FIELDS)
 
-        # Get movie details for the matching ID if it exists
-        movie_check = Movie.query.get(id)
+        except ValueError:
+            # Same status as the collection route for the same bad body
+            abort(422)
 
-        if movie_check is None:
-            try:
-                forced_id = id
-                title = body.get('title', None)
-                release_date = body.get('release_date', None)
-
-                if title and release_date:
-                    date_details = release_date.split('-')
-                    year = int(date_details[0])
-                    month = int(date_details[1])
-                    day = int(date_details[2])
-
-                    movie = Movie(
-                        title=title,
-                        release_date=datetime.datetime(year, month, day))
-                    movie.id = forced_id
-
-                    try:
-                        movie.insert()
-
-                    except Exception:
-                        abort(422)
-
-                    return jsonify({
-                        'success': True,
-                        'movie_id': movie.id,
-                        'movie_title': movie.title,
-                        'movie_release_date': movie.release_date
-                    })
-
-                else:
-                    abort(400)
-
-            except Exception:
-                # Return Unprocessable Entity error if the Try block fails
-                abort(422)
-
-        else:
+        try:
+            # Insert atomically; concurrent writers of the same ID can't race
+            with shard_for(id):
+                created = insert_if_absent(Movie, dict(movie, id=id))
+
+        except Exception:
+            # Return Unprocessable Entity error if the Try block fails
+            abort(422)
+
+        if created:
             return jsonify({
-                'success': False,
-                'movie_id': movie_check.id,
-                'movie_title': movie_check.title,
-                'movie_release_date': movie_check.release_date,
-                'movie_cast': movie_check.cast,
-                'message': 'A movie with that ID alread exists.'
-            }), 200
+                'success': True,
+                'movie_id': id,
+                'movie_title': movie['title'],
+                'movie_release_date': movie['release_date']
+            })
+
+        # Get movie details for the existing ID
+        with shard_for(id):
+            movie_check = Movie.query.get(id)
+
+        if movie_check is None:
+            abort(422)
+
+        load_casts([movie_check])
+
+        return jsonify({
+            'success': False,
+            'movie_id': movie_check.id,
+            'movie_title': movie_check.title,
+            'movie_release_date': movie_check.release_date,
+            'movie_cast': movie_check.cast,
+            'message': 'A movie with that ID alread exists.'
+        }), 200
     # END Testing Routes for Postman
 
     # Error Handling
@@ -1,9 +1,12 @@
 import os
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
 
@@ -11,6 +14,21 @@ AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 
+# JWKS cache settings
+JWKS_URL = os.getenv('JWKS_URL',
+                     f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_FILE = os.getenv('JWKS_FILE')
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 600))
+JWKS_REFRESH_COOLDOWN = int(os.getenv('JWKS_REFRESH_COOLDOWN', 30))
+JWKS_FETCH_TIMEOUT = int(os.getenv('JWKS_FETCH_TIMEOUT', 5))
+JWKS_BACKGROUND_REFRESH = os.getenv('JWKS_BACKGROUND_REFRESH') == '1'
+JWK_FIELDS = ('kty', 'kid', 'use', 'n', 'e')
+
+# Verified token cache settings
+TOKEN_CACHE_ENABLED = os.getenv('TOKEN_CACHE_ENABLED', '1') == '1'
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+TOKEN_CACHE_LEEWAY = int(os.getenv('TOKEN_CACHE_LEEWAY', 30))
+
 
 class AuthError(Exception):  # AuthError Exception
     def __init__(self, error, status_code):
@@ -18,6 +36,274 @@ class AuthError(Exception):  # AuthError Exception
         self.status_code = status_code
 
 
+# JWKS Cache
+def parse_max_age(cache_control):
+    # Return the max-age directive of a Cache-Control header, if any
+    if not cache_control:
+        return None
+
+    directives = [part.strip().lower() for part in cache_control.split(',')]
+
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return int(directive.split('=', 1)[1])
+
+            except ValueError:
+                return None
+
+    return None
+
+
+def fetch_jwks(url):
+    # Download the JWKS document and the TTL advertised by the provider
+    with urlopen(url, timeout=JWKS_FETCH_TIMEOUT) as response:
+        jwks = json.loads(response.read())
+        max_age = parse_max_age(response.headers.get('Cache-Control'))
+
+    return jwks, max_age
+
+
+class JWKSCache:
+    '''
+    Process-wide cache of the signing keys published by Auth0, indexed by
+    kid. Lookups are plain dict reads; the network is only touched when the
+    cached document has expired or a token names a kid we have not seen.
+    '''
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 cooldown=JWKS_REFRESH_COOLDOWN, fetcher=fetch_jwks):
+        self.url = url
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self.fetcher = fetcher
+
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = None
+        self._flight = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def load(self, jwks, ttl=None):
+        # Index the keys by kid and swap them in as a single reference
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' in key:
+                keys[key['kid']] = {
+                    field: key[field] for field in JWK_FIELDS if field in key
+                }
+
+        if ttl is None:
+            ttl = self.ttl
+
+        self._keys = keys
+        self._expires_at = time.monotonic() + max(ttl, self.cooldown)
+
+    def load_file(self, path):
+        with open(path) as jwks_file:
+            self.load(json.load(jwks_file))
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self._expires_at
+
+    def refresh(self, force=False):
+        # Single-flight: callers arriving during a refresh wait for its
+        # result. The lock never spans the fetch, so a greenlet waiting on
+        # it cannot hold up the one doing the network I/O
+        with self._lock:
+            flight = self._flight
+            leader = flight is None
+
+            if leader:
+                now = time.monotonic()
+                if not force and self._last_fetch is not None and \
+                        now - self._last_fetch < self.cooldown:
+                    return False
+
+                self._last_fetch = now
+                flight = self._flight = threading.Event()
+
+        if not leader:
+            flight.wait(JWKS_FETCH_TIMEOUT)
+            return False
+
+        try:
+            jwks, max_age = self.fetcher(self.url)
+
+        except Exception:
+            self.refresh_errors += 1
+            return False
+
+        else:
+            self.load(jwks, max_age)
+            self.refreshes += 1
+            return True
+
+        finally:
+            with self._lock:
+                self._flight = None
+
+            flight.set()
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+
+        if key is not None:
+            self.hits += 1
+
+            # Stale keys are still served while the refresher catches up
+            if self.expired and not self.background_refresh_running:
+                self.refresh()
+                return self._keys.get(kid, key)
+
+            return key
+
+        # Unknown kid; the provider may have rotated its keys
+        self.misses += 1
+        self.refresh()
+        return self._keys.get(kid)
+
+    @property
+    def background_refresh_running(self):
+        return self._refresher is not None and self._refresher.is_alive()
+
+    def start_background_refresh(self, margin=30):
+        if self.background_refresh_running:
+            return
+
+        def refresh_loop():
+            while True:
+                if not self._keys or self.expired:
+                    self.refresh()
+
+                # Wake up shortly before the current document expires
+                delay = self._expires_at - time.monotonic() - margin
+                if self._stop.wait(max(delay, self.cooldown)):
+                    return
+
+        self._stop.clear()
+        self._refresher = threading.Thread(
+            target=refresh_loop, name='jwks-refresher', daemon=True)
+        self._refresher.start()
+
+    def stop_background_refresh(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'keys': len(self._keys),
+            'expires_in': max(self._expires_at - time.monotonic(), 0)
+        }
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+# Keys shipped with the deployment let the first request skip the network
+if JWKS_FILE:
+    jwks_cache.load_file(JWKS_FILE)
+
+
+# Verified Token Cache
+class TokenCache:
+    '''
+    Bounded LRU of verified token payloads keyed by a SHA-256 of the raw
+    token. Entries expire TOKEN_CACHE_LEEWAY seconds before the token's exp
+    claim, so a cached token is never accepted past its expiry.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, leeway=TOKEN_CACHE_LEEWAY,
+                 enabled=TOKEN_CACHE_ENABLED):
+        self.maxsize = maxsize
+        self.leeway = leeway
+        self.enabled = enabled
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def token_key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        # Return (payload, permissions) for a verified, unexpired token
+        if not self.enabled:
+            return None
+
+        key = self.token_key(token)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, permissions, expires_at = entry
+
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def put(self, token, payload, permissions):
+        # Tokens without a usable exp claim are never cached
+        if not self.enabled or not isinstance(payload.get('exp'), int):
+            return
+
+        expires_at = payload['exp'] - self.leeway
+        if time.time() >= expires_at:
+            return
+
+        key = self.token_key(token)
+
+        with self._lock:
+            self._entries[key] = (payload, permissions, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries)
+        }
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 def get_token_auth_header():
     # Access the authorization header
@@ -52,14 +338,25 @@ def get_token_auth_header():
     return authToken
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:  # Check for 'permissions' key
+def get_permissions(payload):
+    # Precompute the permission set once per verified token
+    if 'permissions' not in payload:
+        return None
+
+    return frozenset(payload['permissions'])
+
+
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        permissions = get_permissions(payload)
+
+    if permissions is None:  # Check for 'permissions' key
         raise AuthError({
             'code': 'invalid_permission',
             'description': 'Permission was not specified in the token.'
         }, 401)
 
-    if permission not in payload['permissions']:  # Check for permission
+    if permission not in permissions:  # Check for permission
         raise AuthError({
             'code': 'unauthorized',
             'description': 'You cannot access to this feature.'
@@ -68,10 +365,11 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # python-jose loads its crypto backends on import; defer that cost from
+    # startup to the first token that misses the verified token cache
+    from jose import jwt
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -79,15 +377,8 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # Look up the signing key in the process-wide JWKS cache
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
 
     if rsa_key:
         try:
@@ -126,13 +417,28 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+def verify_token(token):
+    # Skip signature verification for tokens we have already verified
+    cached = token_cache.get(token)
+
+    if cached is not None:
+        return cached
+
+    payload = verify_decode_jwt(token)
+    permissions = get_permissions(payload)
+    token_cache.put(token, payload, permissions)
+
+    return payload, permissions
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, permissions = verify_token(token)
+            check_permissions(permission, payload, permissions)
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,35 @@
+'''
+Micro-benchmark of the per-request cost of requires_auth with the verified
+token cache disabled (cold, full RS256 verify) and enabled (warm).
+
+Usage: python benchmarks/bench_auth.py [iterations]
+'''
+import sys
+import timeit
+
+from flask import Flask
+
+from common import auth, make_headers
+
+
+def main(iterations):
+    @auth.requires_auth('get:actors')
+    def handler(payload):
+        return payload
+
+    app = Flask(__name__)
+
+    with app.test_request_context(headers=make_headers(['get:actors'])):
+        for enabled in (False, True):
+            auth.token_cache.enabled = enabled
+            auth.token_cache.clear()
+            handler()
+
+            seconds = timeit.timeit(handler, number=iterations)
+            print('{:<6} {:>10.1f} us/request'.format(
+                'warm' if enabled else 'cold',
+                seconds / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,38 @@
+'''
+Throughput of creating actors one request at a time (POST /actors, one
+commit each) against POST /actors/bulk (one statement and commit per
+chunk).
+
+Usage: python benchmarks/bench_bulk_insert.py [actors]
+'''
+import os
+import sys
+import time
+
+from common import make_app, make_headers
+
+
+def main(total):
+    app, db_file = make_app()
+    client = app.test_client()
+    headers = make_headers()
+    actors = [{'name': 'Actor {}'.format(number), 'age': 40,
+               'gender': 'Female'} for number in range(total)]
+
+    start = time.perf_counter()
+    for actor in actors:
+        client.post('/actors', json=actor, headers=headers)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client.post('/actors/bulk', json=actors, headers=headers)
+    bulk = time.perf_counter() - start
+
+    print('single {:>10.0f} actors/s'.format(total / single))
+    print('bulk   {:>10.0f} actors/s'.format(total / bulk))
+
+    os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
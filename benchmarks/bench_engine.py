@@ -0,0 +1,84 @@
+'''
+Read and write throughput with concurrent readers and writers under the
+default and tuned engine profiles. Without a database URI a fresh SQLite
+file is used per profile.
+
+Usage: python benchmarks/bench_engine.py [seconds] [readers] [database uri]
+'''
+import os
+import sys
+import time
+import threading
+
+from common import make_app
+from app import get_page
+from models import db, Actor, insert_many
+
+WRITERS = 2
+
+
+def run(app, seconds, readers):
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def loop(operation, name):
+        with app.app_context():
+            while time.time() < deadline:
+                try:
+                    operation()
+                    result = name
+
+                except Exception:
+                    db.session.rollback()
+                    result = 'errors'
+
+                with lock:
+                    counts[result] += 1
+
+            db.session.remove()
+
+    def read():
+        get_page(Actor, 50)
+        db.session.commit()
+
+    def write():
+        insert_many(Actor, [{'name': 'Writer', 'age': 30,
+                             'gender': 'Female'}])
+
+    threads = [threading.Thread(target=loop, args=(read, 'reads'))
+               for number in range(readers)] + \
+        [threading.Thread(target=loop, args=(write, 'writes'))
+         for number in range(WRITERS)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return counts
+
+
+def main(seconds, readers, database_uri):
+    for profile in ('default', 'tuned'):
+        app, db_file = make_app(database_uri, {'DB_PROFILE': profile})
+
+        with app.app_context():
+            insert_many(Actor, [{'name': 'Actor', 'age': 40,
+                                 'gender': 'Male'} for number in range(1000)])
+
+        counts = run(app, seconds, readers)
+        print('{:<8} {:>8.0f} reads/s {:>7.0f} writes/s {:>5} errors'.format(
+            profile, counts['reads'] / seconds, counts['writes'] / seconds,
+            counts['errors']))
+
+        with app.app_context():
+            db.get_engine(app).dispose()
+        if db_file:
+            os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 5,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+         sys.argv[3] if len(sys.argv) > 3 else None)
@@ -0,0 +1,62 @@
+'''
+Latency and peak memory of building one page of actors as full ORM objects
+with format(), against selecting only id and name with fields=id,name.
+
+Usage: python benchmarks/bench_fields.py [actors] [page size]
+'''
+import os
+import sys
+import timeit
+import tracemalloc
+
+from common import make_app
+from app import get_page, field_formatter, ACTOR_COLUMNS
+from models import db, Actor
+
+BATCH = 50000
+
+
+def full_page(limit):
+    rows, cursor = get_page(Actor, limit)
+    body = [row.format() for row in rows]
+    db.session.remove()
+    return body
+
+
+def sparse_page(limit):
+    formatter = field_formatter(['id', 'name'], ACTOR_COLUMNS)
+    rows, cursor = get_page(Actor, limit, selected=[Actor.id, Actor.name])
+    body = [formatter(row) for row in rows]
+    db.session.remove()
+    return body
+
+
+def main(total, limit):
+    app, db_file = make_app()
+
+    with app.app_context():
+        for first in range(0, total, BATCH):
+            db.session.execute(Actor.__table__.insert(), [
+                {'name': 'Actor {}'.format(number), 'age': 20 + number % 60,
+                 'gender': 'Female'}
+                for number in range(first, min(first + BATCH, total))])
+        db.session.commit()
+
+        for name, build in (('full', full_page), ('fields', sparse_page)):
+            build(limit)
+            seconds = timeit.timeit(lambda: build(limit), number=20)
+
+            tracemalloc.start()
+            build(limit)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print('{:<7} {:>8.2f} ms/page {:>8.0f} KiB peak'.format(
+                name, seconds / 20 * 1000, peak / 1024))
+
+    os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,69 @@
+'''
+Benchmark of the actor filmography lookup as the movie table grows. The
+measured actor always has the same number of movies, so the lookup time
+should stay flat while the table grows to the final size.
+
+Usage: python benchmarks/bench_filmography.py [movies]
+'''
+import os
+import sys
+import random
+import datetime
+import timeit
+
+from common import make_app
+from app import get_filmography_page
+from models import db, Actor, Movie, movie_actors
+
+ACTORS = 1000
+TARGET_MOVIES = 50
+BATCH = 50000
+
+
+def grow(start, stop):
+    # Bulk load movies, each with one random cast member
+    epoch = datetime.datetime(1950, 1, 1)
+    for first in range(start, stop, BATCH):
+        last = min(first + BATCH, stop)
+        db.session.execute(Movie.__table__.insert(), [
+            {'id': movie_id, 'title': 'Movie {}'.format(movie_id),
+             'release_date': epoch + datetime.timedelta(days=movie_id % 25000)}
+            for movie_id in range(first + 1, last + 1)])
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': movie_id, 'actor_id': random.randint(2, ACTORS)}
+            for movie_id in range(first + 1, last + 1)])
+    db.session.commit()
+
+
+def main(total):
+    app, db_file = make_app()
+
+    with app.app_context():
+        db.session.execute(Actor.__table__.insert(), [
+            {'id': actor_id, 'name': 'Actor', 'age': 40, 'gender': 'Female'}
+            for actor_id in range(1, ACTORS + 1)])
+
+        size = 0
+        for target in (total // 100, total // 10, total):
+            grow(size, target)
+            size = target
+
+            # Re-point the measured actor at a fixed number of movies
+            db.session.execute(movie_actors.delete().where(
+                movie_actors.c.actor_id == 1))
+            db.session.execute(movie_actors.insert(), [
+                {'movie_id': movie_id, 'actor_id': 1}
+                for movie_id in random.sample(range(1, size + 1),
+                                              TARGET_MOVIES)])
+            db.session.commit()
+
+            seconds = timeit.timeit(
+                lambda: get_filmography_page(1, TARGET_MOVIES), number=50)
+            print('{:>9} movies {:>8.2f} ms/lookup'.format(
+                size, seconds / 50 * 1000))
+
+    os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,55 @@
+'''
+Serialization cost of a list response of Movie.format() dicts through
+Flask's default encoder, the stdlib provider and the orjson provider.
+
+Usage: python benchmarks/bench_json.py [movies]
+'''
+import sys
+import datetime
+import timeit
+
+from flask import json as flask_json
+
+from common import make_app
+from models import Actor, Movie
+from serialization import get_provider, orjson
+
+
+def make_movies(count):
+    # Transient rows; format() needs no database
+    epoch = datetime.datetime(1950, 1, 1)
+    movies = []
+
+    for number in range(count):
+        movie = Movie('Movie {}'.format(number),
+                      epoch + datetime.timedelta(days=number))
+        movie.id = number + 1
+        actor = Actor('Actor {}'.format(number), 40, 'Female')
+        actor.id = number + 1
+        movie.actors = [actor]
+        movies.append(movie)
+
+    return movies
+
+
+def main(count):
+    app, db_file = make_app('sqlite://')
+    body = {'success': True,
+            'movies': [movie.format() for movie in make_movies(count)],
+            'movie_count': count, 'next_cursor': None}
+
+    encoders = [('flask', flask_json.dumps),
+                ('stdlib', get_provider('stdlib').dumps_bytes)]
+    if orjson is not None:
+        encoders.append(('orjson', get_provider('orjson').dumps_bytes))
+
+    with app.app_context():
+        app.json_encoder = flask_json.JSONEncoder
+        for name, encode in encoders:
+            seconds = timeit.timeit(lambda: encode(body), number=20)
+            print('{:<7} {:>8.2f} ms/response'.format(
+                name, seconds / 20 * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
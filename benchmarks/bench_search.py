@@ -0,0 +1,50 @@
+'''
+Latency of prefix search over actor names through the full-text index,
+against a LIKE '%term%' scan of the same table.
+
+Usage: python benchmarks/bench_search.py [actors]
+'''
+import os
+import sys
+import random
+import timeit
+
+from common import make_app
+from models import db, Actor
+from search import search
+
+SYLLABLES = ['ro', 'bin', 'wil', 'li', 'ams', 'mer', 'yl', 'stre', 'ep',
+             'tom', 'han', 'ks', 'den', 'zel', 'wa', 'shing', 'ton', 'ka']
+BATCH = 50000
+
+
+def random_name():
+    return ' '.join(''.join(random.choice(SYLLABLES)
+                            for _ in range(random.randint(2, 4))).title()
+                    for _ in range(2))
+
+
+def main(total):
+    app, db_file = make_app()
+
+    with app.app_context():
+        for start in range(0, total, BATCH):
+            db.session.execute(Actor.__table__.insert(), [
+                {'name': random_name(), 'age': 40, 'gender': 'Female'}
+                for _ in range(min(BATCH, total - start))])
+        db.session.commit()
+
+        for term in ('robin', 'stre', 'kaden wash'):
+            seconds = timeit.timeit(lambda: search(Actor, term, 20),
+                                    number=20)
+            like = timeit.timeit(lambda: Actor.query.filter(
+                Actor.name.like('%{}%'.format(term))).limit(20).all(),
+                number=5)
+            print('{:<12} search {:>8.2f} ms   like {:>8.2f} ms'.format(
+                term, seconds / 20 * 1000, like / 5 * 1000))
+
+    os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
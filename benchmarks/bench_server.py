@@ -0,0 +1,164 @@
+'''
+Load test of the app under gunicorn in each worker mode of gunicorn.conf.py,
+plus the old Procfile setup of one sync worker. Concurrent clients read
+/actors while one client holds a /events stream open, the way a dashboard
+would. Each mode gets a fresh copy of the migrated database.db.
+
+Usage: python benchmarks/bench_server.py [seconds] [clients]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import statistics
+from urllib.request import Request, urlopen
+
+from jose import jwk
+
+from common import make_token, public_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = [
+    ('single sync', {'GUNICORN_WORKER_MODE': 'sync', 'WEB_CONCURRENCY': '1'}),
+    ('sync', {'GUNICORN_WORKER_MODE': 'sync'}),
+    ('threaded', {'GUNICORN_WORKER_MODE': 'threaded'}),
+    ('gevent', {'GUNICORN_WORKER_MODE': 'gevent'}),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, deadline=30):
+    started = time.time()
+
+    while time.time() - started < deadline:
+        try:
+            urlopen(url, timeout=1).close()
+
+        except OSError as error:
+            # Any HTTP status means the server is answering
+            if hasattr(error, 'code'):
+                return
+            time.sleep(0.2)
+
+        else:
+            return
+
+    raise RuntimeError('gunicorn did not start')
+
+
+def hold_stream(url, headers, stop):
+    try:
+        with urlopen(Request(url, headers=headers), timeout=60) as response:
+            while not stop.is_set():
+                response.readline()
+
+    except OSError:
+        pass
+
+
+def run(base_url, headers, seconds, clients):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def client():
+        while time.time() < deadline:
+            started = time.perf_counter()
+
+            try:
+                with urlopen(Request(base_url + '/actors?limit=20',
+                                     headers=headers), timeout=10) as response:
+                    response.read()
+
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors[0]
+
+
+def main(seconds, clients):
+    work_dir = tempfile.mkdtemp()
+    jwks_file = os.path.join(work_dir, 'jwks.json')
+
+    with open(jwks_file, 'w') as out:
+        json.dump({'keys': [dict(
+            jwk.construct(public_key.save_pkcs1().decode(), 'RS256').to_dict(),
+            kid='bench-key', use='sig')]}, out)
+
+    headers = {'Authorization': 'Bearer ' + make_token()}
+
+    try:
+        for name, settings in MODES:
+            db_file = os.path.join(work_dir, 'database.db')
+            shutil.copy(os.path.join(ROOT, 'database.db'), db_file)
+
+            port = free_port()
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            env = dict(os.environ, DATABASE_URL='sqlite:///' + db_file,
+                       JWKS_FILE=jwks_file, PORT=str(port), **settings)
+
+            server = subprocess.Popen(
+                ['gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
+                cwd=ROOT, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            stop = threading.Event()
+
+            try:
+                wait_until_up(base_url + '/')
+                stream = threading.Thread(
+                    target=hold_stream, daemon=True,
+                    args=(base_url + '/events', headers, stop))
+                stream.start()
+                time.sleep(0.5)
+
+                latencies, errors = run(base_url, headers, seconds, clients)
+
+            finally:
+                stop.set()
+                server.terminate()
+                server.wait()
+                os.remove(db_file)
+
+            if latencies:
+                latencies.sort()
+                print('{:<12} {:>8.0f} req/s {:>8.1f} ms p50 {:>8.1f} ms p99 '
+                      '{:>5} errors'.format(
+                          name, len(latencies) / seconds,
+                          statistics.median(latencies) * 1000,
+                          latencies[int(len(latencies) * 0.99)] * 1000,
+                          errors))
+
+            else:
+                print('{:<12} {:>8} req/s {:>27} {:>5} errors'.format(
+                    name, 0, '', errors))
+
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 10,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 16)
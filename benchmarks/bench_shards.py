@@ -0,0 +1,77 @@
+'''
+Write and read throughput with actors and movies hash-sharded across 1, 2
+and 4 SQLite files, against the same app on one database. Several threads
+create actors one request at a time, then read pages of /actors, which
+every shard answers and the app merges.
+
+Usage: python benchmarks/bench_shards.py [actors] [threads]
+'''
+import os
+import sys
+import time
+import tempfile
+import threading
+
+from common import make_app, make_headers
+
+
+def temp_file():
+    db_fd, db_file = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    return db_file
+
+
+def run(threads, call, count):
+    # Every thread makes count calls; returns calls per second
+    def worker():
+        for number in range(count):
+            call(number)
+
+    workers = [threading.Thread(target=worker) for number in range(threads)]
+
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return threads * count / (time.perf_counter() - start)
+
+
+def main(total, threads):
+    from models import db, dispose_engines
+
+    headers = make_headers()
+
+    for shard_count in (0, 1, 2, 4):
+        shard_files = [temp_file() for number in range(shard_count)]
+        app, db_file = make_app(config={'SQLALCHEMY_SHARD_URIS': [
+            'sqlite:///' + shard_file for shard_file in shard_files]})
+
+        def create(number):
+            app.test_client().post('/actors', headers=headers, json={
+                'name': 'Actor {}'.format(number), 'age': 40,
+                'gender': 'Female'})
+
+        def read(number):
+            app.test_client().get('/actors?limit=20&sort=-age',
+                                  headers=headers)
+
+        writes = run(threads, create, total // threads)
+        reads = run(threads, read, total // threads // 4)
+
+        print('{:<12} {:>8.0f} writes/s {:>8.0f} reads/s'.format(
+            '{} shards'.format(shard_count) if shard_count else 'unsharded',
+            writes, reads))
+
+        with app.app_context():
+            db.session.remove()
+            dispose_engines(app)
+
+        for name in [db_file] + shard_files:
+            os.remove(name)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 8)
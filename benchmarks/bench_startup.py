@@ -0,0 +1,69 @@
+'''
+Cold start cost: time to import the app module (which creates the app) and
+to serve the first authenticated request, each measured in a fresh
+interpreter against a copy of the migrated database.db.
+
+Usage: python benchmarks/bench_startup.py [runs]
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import statistics
+
+from jose import jwk
+
+from common import make_token, public_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child; the token and keys come from the parent so the child
+# only loads what the app itself needs
+CHILD = '''
+import os, sys, json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+import auth
+auth.jwks_cache.load(json.loads(os.environ['BENCH_JWKS']))
+response = app.app.test_client().get('/actors', headers={
+    'Authorization': 'Bearer ' + os.environ['BENCH_TOKEN']})
+assert response.status_code == 200, response.status_code
+print(json.dumps([imported - started, time.perf_counter() - imported]))
+'''
+
+
+def measure(env):
+    output = subprocess.run([sys.executable, '-c', CHILD], env=env, cwd=ROOT,
+                            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def main(runs):
+    db_dir = tempfile.mkdtemp()
+    db_file = os.path.join(db_dir, 'database.db')
+    shutil.copy(os.path.join(ROOT, 'database.db'), db_file)
+
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + db_file,
+               BENCH_TOKEN=make_token(),
+               BENCH_JWKS=json.dumps({'keys': [dict(
+                   jwk.construct(public_key.save_pkcs1().decode(),
+                                 'RS256').to_dict(),
+                   kid='bench-key', use='sig')]}))
+    env.pop('DB_CREATE_ALL', None)
+
+    try:
+        timings = [measure(env) for run in range(runs)]
+    finally:
+        shutil.rmtree(db_dir)
+
+    for index, name in enumerate(('import', 'first request')):
+        samples = [timing[index] * 1000 for timing in timings]
+        print('{:<14} {:>8.1f} ms median {:>8.1f} ms max'.format(
+            name, statistics.median(samples), max(samples)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,57 @@
+'''
+Latency of PATCH/DELETE style writes: the old load-modify-commit path
+through the ORM against the single UPDATE ... RETURNING / DELETE statement
+path. Runs on a throwaway SQLite file, or on BENCH_DATABASE_URL (for
+example a Postgres database) when it is set.
+
+Usage: python benchmarks/bench_write_paths.py [rows]
+'''
+import os
+import sys
+import time
+
+from common import make_app
+from models import db, Actor, update_row, delete_row, insert_many
+
+
+def timed(label, operation, ids):
+    start = time.perf_counter()
+    for row_id in ids:
+        operation(row_id)
+        db.session.remove()
+    elapsed = time.perf_counter() - start
+    print('{:<22} {:>8.1f} us/write'.format(label, elapsed / len(ids) * 1e6))
+
+
+def orm_update(row_id):
+    actor = Actor.query.get(row_id)
+    actor.age = 50
+    actor.update()
+
+
+def orm_delete(row_id):
+    Actor.query.get(row_id).delete()
+
+
+def main(rows):
+    app, db_file = make_app(os.getenv('BENCH_DATABASE_URL'))
+
+    with app.app_context():
+        ids = insert_many(Actor, [
+            {'name': 'Actor', 'age': 40, 'gender': 'Female'}
+            for _ in range(rows * 2)])
+        first, second = ids[:rows], ids[rows:]
+
+        timed('orm update', orm_update, first)
+        timed('update ... returning',
+              lambda row_id: update_row(Actor, row_id, {'age': 60}), first)
+        timed('orm delete', orm_delete, first)
+        timed('single delete',
+              lambda row_id: delete_row(Actor, row_id), second)
+
+    if db_file:
+        os.remove(db_file)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
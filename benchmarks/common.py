@@ -0,0 +1,55 @@
+'''
+Shared setup for the benchmarks: a local signing key registered with the
+JWKS cache and an app bound to a throwaway SQLite file.
+'''
+import os
+import sys
+import time
+import tempfile
+
+import rsa
+from jose import jwk, jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth  # noqa: E402
+
+ALL_PERMISSIONS = [
+    'get:actors', 'get:movies', 'post:actors', 'post:movies',
+    'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'
+]
+
+public_key, private_key = rsa.newkeys(2048)
+auth.jwks_cache.load({'keys': [dict(
+    jwk.construct(public_key.save_pkcs1().decode(), 'RS256').to_dict(),
+    kid='bench-key', use='sig')]})
+
+
+def make_token(permissions=ALL_PERMISSIONS):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://' + str(auth.AUTH0_DOMAIN) + '/',
+        'aud': auth.API_AUDIENCE,
+        'iat': now,
+        'exp': now + 3600,
+        'permissions': permissions
+    }, private_key.save_pkcs1().decode(), algorithm='RS256',
+        headers={'kid': 'bench-key'})
+
+
+def make_headers(permissions=ALL_PERMISSIONS):
+    return {'Authorization': 'Bearer ' + make_token(permissions)}
+
+
+def make_app(database_uri=None, config=None):
+    # Returns the app and the SQLite file to remove afterwards, if any
+    from app import create_app
+
+    db_file = None
+    if database_uri is None:
+        db_fd, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+        database_uri = 'sqlite:///' + db_file
+
+    return create_app(dict({'DB_CREATE_ALL': True}, **(config or {}),
+                           SQLALCHEMY_DATABASE_URI=database_uri)), db_file
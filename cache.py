@@ -0,0 +1,443 @@
+'''
+Response cache and conditional GETs for the read endpoints.
+
+Serialized bodies are kept in a per-process LRU, optionally backed by a
+shared store so workers can reuse each other's responses. Keys include the
+change versions of every table a response depends on; a write bumps the
+version inside its own transaction, so later reads look up a new key and
+never see a body rendered before the write.
+
+The same versions give every read a strong ETag, so clients polling with
+If-None-Match get 304 Not Modified without the query being run.
+
+Below whole responses, the encoded JSON of each row is cached by its row
+version, so any page or filter of a list only re-encodes changed rows.
+
+Concurrent misses on the same key are coalesced: one request runs the
+handler and the others wait for its result. The primitives come from
+threading, which gevent patches, so this works with thread and gevent
+workers alike.
+'''
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, g, Response
+
+from models import get_table_state, row_change_listeners
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_URL = os.getenv('RESPONSE_CACHE_URL')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+REQUEST_COALESCING_ENABLED = \
+    os.getenv('REQUEST_COALESCING_ENABLED', '1') == '1'
+FRAGMENT_CACHE_ENABLED = os.getenv('FRAGMENT_CACHE_ENABLED', '1') == '1'
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', 10000))
+
+
+class LRUBackend:
+    # Bounded in-process store; the first level of every response cache
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+
+            if value is not None:
+                self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    # Shared store for all workers; needs the optional redis package
+
+    def __init__(self, url, ttl=RESPONSE_CACHE_TTL):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl or self.ttl)
+
+
+class ResponseCache:
+
+    def __init__(self, namespace, local=None, shared=None,
+                 enabled=RESPONSE_CACHE_ENABLED):
+        self.namespace = namespace
+        self.local = local if local is not None else LRUBackend()
+        self.shared = shared
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, route, params, scope, versions):
+        raw = json.dumps([self.namespace, route, params, scope, versions],
+                         separators=(',', ':'), sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        body = self.local.get(key)
+
+        if body is None and self.shared is not None:
+            body = self.shared.get(key)
+
+            if body is not None:
+                self.local.set(key, body)
+
+        if body is None:
+            self.misses += 1
+
+        else:
+            self.hits += 1
+
+        return body
+
+    def set(self, key, body):
+        self.local.set(key, body)
+
+        if self.shared is not None:
+            self.shared.set(key, body)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self.local)
+        }
+
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight:
+    # Runs one call per key at a time; callers arriving meanwhile share it
+
+    def __init__(self, enabled=REQUEST_COALESCING_ENABLED):
+        self.enabled = enabled
+
+        self.leaders = 0
+        self.coalesced = 0
+
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call):
+        '''
+        do(key, call)
+            returns call() and whether the result was shared from a call
+            already in flight for key
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+
+            # The leader's exception is its own; run the call separately
+            if flight.failed:
+                return call(), False
+
+            return flight.result, True
+
+        try:
+            flight.result = call()
+
+        except BaseException:
+            flight.failed = True
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+        return flight.result, False
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._flights)
+        }
+
+
+class FragmentCache:
+    # Encoded rows by (table, id); each entry holds the version it encodes
+
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE,
+                 enabled=FRAGMENT_CACHE_ENABLED):
+        self.maxsize = maxsize
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, table, row_id, version, variant, encode):
+        '''
+        get(table, row_id, version, variant, encode)
+            returns the cached fragment of the row if it was encoded at
+            version, otherwise calls encode() and caches its result
+        '''
+        if not self.enabled:
+            return encode()
+
+        key = (table, row_id)
+
+        with self._lock:
+            variants = self._entries.get(key)
+            entry = variants.get(variant) if variants else None
+
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        fragment = encode()
+
+        with self._lock:
+            self.misses += 1
+            variants = self._entries.setdefault(key, {})
+            variants[variant] = (version, fragment)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return fragment
+
+    def discard(self, table, row_ids):
+        with self._lock:
+            for row_id in row_ids:
+                self._entries.pop((table, row_id), None)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self._entries)
+        }
+
+
+def discard_fragments(name, row_ids):
+    # Updated and deleted rows are dropped as soon as they are written
+    cache = current_app.extensions.get('fragment_cache') \
+        if current_app else None
+
+    if cache is not None:
+        cache.discard(name, row_ids)
+
+
+row_change_listeners.append(discard_fragments)
+
+
+def row_encoder(table, formatter, version_of=None, variant=''):
+    '''
+    row_encoder(table, formatter)
+        returns a function encoding a row to JSON bytes through the app's
+        fragment cache, keyed by the row version
+    '''
+    cache = current_app.extensions['fragment_cache']
+    provider = current_app.extensions['json_provider']
+
+    if version_of is None:
+        def version_of(row):
+            return row.row_version
+
+    def encode(row):
+        return cache.get(table, row.id, version_of(row), variant,
+                         lambda: provider.dumps_bytes(formatter(row)))
+
+    return encode
+
+
+def init_response_cache(app):
+    # One cache per app, namespaced by database so apps never share entries
+    shared = RedisBackend(RESPONSE_CACHE_URL) if RESPONSE_CACHE_URL else None
+    namespace = hashlib.sha256(
+        app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:16]
+
+    app.extensions['response_cache'] = ResponseCache(namespace, shared=shared)
+    app.extensions['fragment_cache'] = FragmentCache()
+    app.extensions['single_flight'] = SingleFlight()
+
+
+def table_state(*tables):
+    # Read the versions once per request, however many decorators need them
+    states = g.setdefault('table_states', {})
+
+    if tables not in states:
+        states[tables] = get_table_state(*tables)
+
+    return states[tables]
+
+
+def make_etag(route, params, versions):
+    raw = json.dumps([route, params, versions],
+                     separators=(',', ':'), sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def is_not_modified(etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+
+    return False
+
+
+def conditional_response(*tables, skip=None):
+    '''
+    conditional_response(*tables)
+        adds an ETag and Last-Modified header derived from the change
+        versions of tables, and answers 304 Not Modified without calling
+        the handler when the client's copy is still current
+    '''
+    def conditional_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if skip is not None and skip():
+                return f(*args, **kwargs)
+
+            versions, last_modified = table_state(*tables)
+            etag = make_etag(request.path,
+                             sorted(request.args.items(multi=True)), versions)
+
+            # HTTP dates have whole seconds
+            if last_modified is not None:
+                last_modified = last_modified.replace(microsecond=0)
+
+            if is_not_modified(etag, last_modified):
+                response = Response(status=304)
+
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return wrapper
+    return conditional_response_decorator
+
+
+def cached_response(*tables, skip=None):
+    '''
+    cached_response(*tables)
+        caches the JSON body of a GET handler wrapped by requires_auth,
+        keyed by route, query params, permission scope and the change
+        versions of the tables the response is built from; concurrent
+        misses on the same key share one call of the handler
+    '''
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            flight = current_app.extensions.get('single_flight')
+            caching = cache is not None and cache.enabled
+            coalescing = flight is not None and flight.enabled
+
+            if not (caching or coalescing) or \
+                    (skip is not None and skip()):
+                return f(payload, *args, **kwargs)
+
+            key = cache.make_key(
+                request.path,
+                sorted(request.args.items(multi=True)),
+                sorted(payload.get('permissions', [])),
+                table_state(*tables)[0])
+
+            body = cache.get(key) if caching else None
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            def render():
+                # Followers rebuild their own response from these parts
+                response = current_app.make_response(
+                    f(payload, *args, **kwargs))
+                return response.status_code, response.get_data(), \
+                    response.mimetype
+
+            if coalescing:
+                (status, body, mimetype), shared = flight.do(key, render)
+
+            else:
+                (status, body, mimetype), shared = render(), False
+
+            if caching and not shared and status == 200 and \
+                    mimetype == 'application/json':
+                cache.set(key, body)
+
+            response = Response(body, status=status, mimetype=mimetype)
+            response.headers['X-Cache'] = 'COALESCED' if shared else 'MISS'
+            return response
+
+        return wrapper
+    return cached_response_decorator
@@ -0,0 +1,258 @@
+'''
+Server-Sent Events change feed.
+
+Writes add rows to the change_events outbox in the same transaction as the
+change itself. One poller thread per process reads new outbox rows and fans
+them out to every connected subscriber, so the database sees the same
+polling load however many clients are listening. Clients resume after a
+disconnect by sending the id of the last event they saw in Last-Event-ID.
+'''
+import os
+import json
+import time
+import queue
+import datetime
+import threading
+
+from sqlalchemy import select, func
+
+from models import db, change_events
+
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv('CHANGE_FEED_POLL_INTERVAL', 1))
+CHANGE_FEED_HEARTBEAT = float(os.getenv('CHANGE_FEED_HEARTBEAT', 15))
+CHANGE_FEED_BATCH_SIZE = int(os.getenv('CHANGE_FEED_BATCH_SIZE', 500))
+CHANGE_FEED_QUEUE_SIZE = int(os.getenv('CHANGE_FEED_QUEUE_SIZE', 100))
+CHANGE_FEED_GAP_TIMEOUT = float(os.getenv('CHANGE_FEED_GAP_TIMEOUT', 2))
+CHANGE_FEED_RETENTION = int(os.getenv('CHANGE_FEED_RETENTION', 86400))
+
+SSE_MIMETYPE = 'text/event-stream'
+
+
+def format_event(event):
+    return 'id: {}\nevent: change\ndata: {}\n\n'.format(
+        event['id'], json.dumps({
+            'table': event['table'],
+            'action': event['action'],
+            'id': event['row_id'],
+            'version': event['version']
+        }, separators=(',', ':')))
+
+
+def read_events(after, until=None, limit=CHANGE_FEED_BATCH_SIZE):
+    query = select([change_events]).where(change_events.c.id > after) \
+        .order_by(change_events.c.id).limit(limit)
+
+    if until is not None:
+        query = query.where(change_events.c.id <= until)
+
+    return [{
+        'id': row.id,
+        'table': row.table_name,
+        'row_id': row.row_id,
+        'action': row.action,
+        'version': row.version
+    } for row in db.session.execute(query)]
+
+
+def read_backlog(after, until):
+    # Everything a resuming client missed, read in batches
+    backlog = []
+
+    while True:
+        events = read_events(after, until)
+        backlog += events
+
+        if len(events) < CHANGE_FEED_BATCH_SIZE:
+            return backlog
+
+        after = events[-1]['id']
+
+
+def was_pruned(last_event_id):
+    # True when events after last_event_id are no longer in the outbox
+    first_id = db.session.execute(
+        select([func.min(change_events.c.id)])).scalar()
+
+    return first_id is not None and first_id > last_event_id + 1
+
+
+'''
+prune_events(max_age)
+    deletes outbox rows older than max_age seconds; subscribers resuming
+    from before the cut are told to resync
+'''
+
+
+def prune_events(max_age=CHANGE_FEED_RETENTION):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    result = db.session.execute(change_events.delete().where(
+        change_events.c.created_at < cutoff))
+    db.session.commit()
+
+    return result.rowcount
+
+
+class Subscriber:
+
+    def __init__(self, tables, maxsize=CHANGE_FEED_QUEUE_SIZE):
+        self.tables = tables
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def deliver(self, events):
+        # A client too slow to keep up is dropped and resumes from the outbox
+        try:
+            self.queue.put_nowait(events)
+
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeFeed:
+
+    def __init__(self, app, poll_interval=CHANGE_FEED_POLL_INTERVAL,
+                 heartbeat=CHANGE_FEED_HEARTBEAT,
+                 gap_timeout=CHANGE_FEED_GAP_TIMEOUT):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.gap_timeout = gap_timeout
+
+        self.last_id = 0
+        self.polls = 0
+        self.delivered = 0
+
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._gap = None
+
+    def subscribe(self, tables):
+        '''
+        subscribe(tables)
+            registers a subscriber for events on tables and returns it with
+            the id of the last event the poller has already dispatched
+        '''
+        subscriber = Subscriber(tables)
+
+        with self._lock:
+            if self._thread is None:
+                # The poller starts from the current end of the outbox
+                self.last_id = db.session.execute(
+                    select([func.max(change_events.c.id)])).scalar() or 0
+                self._gap = None
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            self._subscribers.add(subscriber)
+
+            return subscriber, self.last_id
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+
+            with self.app.app_context():
+                try:
+                    self.poll()
+
+                finally:
+                    db.session.remove()
+
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        events = self.take_ready(read_events(self.last_id))
+        self.polls += 1
+
+        if not events:
+            return
+
+        with self._lock:
+            self.last_id = events[-1]['id']
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            subscriber.deliver(events)
+
+        self.delivered += len(events) * len(subscribers)
+
+    def take_ready(self, events):
+        # Ids can commit out of order on Postgres; hold back past a gap
+        # until the missing id commits or is given up as rolled back
+        expected = self.last_id + 1
+        ready = []
+
+        for event in events:
+            if event['id'] != expected:
+                now = time.monotonic()
+
+                if self._gap is None or self._gap[0] != expected:
+                    self._gap = (expected, now)
+
+                if now - self._gap[1] < self.gap_timeout:
+                    break
+
+                self._gap = None
+
+            ready.append(event)
+            expected = event['id'] + 1
+
+        return ready
+
+    def stats(self):
+        return {
+            'subscribers': len(self._subscribers),
+            'polls': self.polls,
+            'delivered': self.delivered,
+            'last_id': self.last_id
+        }
+
+
+def init_change_feed(app):
+    app.extensions['change_feed'] = ChangeFeed(app)
+
+
+def stream_events(feed, subscriber, backlog, last_id, reset=False):
+    '''
+    stream_events(feed, subscriber, backlog, last_id)
+        yields the backlog and then live events as SSE messages, skipping
+        anything at or before last_id, until the client disconnects
+    '''
+    try:
+        if reset:
+            yield 'event: reset\ndata: {}\n\n'
+
+        for event in backlog:
+            if event['table'] in subscriber.tables:
+                yield format_event(event)
+            last_id = event['id']
+
+        while not subscriber.overflowed:
+            try:
+                events = subscriber.queue.get(timeout=feed.heartbeat)
+
+            except queue.Empty:
+                # Comment lines keep proxies from closing idle connections
+                yield ': keep-alive\n\n'
+                continue
+
+            chunk = []
+            for event in events:
+                if event['id'] > last_id and \
+                        event['table'] in subscriber.tables:
+                    chunk.append(format_event(event))
+                last_id = max(last_id, event['id'])
+
+            if chunk:
+                yield ''.join(chunk)
+
+    finally:
+        feed.unsubscribe(subscriber)
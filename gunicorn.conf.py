@@ -0,0 +1,82 @@
+'''
+Gunicorn settings for the API.
+
+GUNICORN_WORKER_MODE picks how each worker serves requests:
+    sync      one request at a time per worker process
+    threaded  GUNICORN_THREADS requests at a time per worker (the default)
+    gevent    up to GUNICORN_WORKER_CONNECTIONS greenlets per worker
+
+The app is imported once in the master and shared copy-on-write by the
+workers. No database connection may cross the fork, so engines are
+disposed on both sides of it.
+'''
+import os
+import multiprocessing
+
+GUNICORN_WORKER_MODE = os.getenv('GUNICORN_WORKER_MODE', 'threaded')
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', 4))
+GUNICORN_WORKER_CONNECTIONS = int(
+    os.getenv('GUNICORN_WORKER_CONNECTIONS', 100))
+
+WORKER_CLASSES = {'sync': 'sync', 'threaded': 'gthread', 'gevent': 'gevent'}
+
+if GUNICORN_WORKER_MODE not in WORKER_CLASSES:
+    raise ValueError('Unknown GUNICORN_WORKER_MODE: ' + GUNICORN_WORKER_MODE)
+
+if GUNICORN_WORKER_MODE == 'gevent':
+    # Patch before preload_app imports the app, so the locks, sockets and
+    # threads it creates at import are already cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:  # Optional; without it Postgres queries block a worker
+        patch_psycopg = None
+
+    if patch_psycopg is not None:
+        patch_psycopg()
+
+cpus = multiprocessing.cpu_count()
+
+bind = '0.0.0.0:' + os.getenv('PORT', '8000')
+worker_class = WORKER_CLASSES[GUNICORN_WORKER_MODE]
+
+# Blocking workers need a process per concurrent request; threads and
+# greenlets overlap the waiting inside each process instead
+if GUNICORN_WORKER_MODE == 'sync':
+    workers = int(os.getenv('WEB_CONCURRENCY', cpus * 2 + 1))
+
+else:
+    workers = int(os.getenv('WEB_CONCURRENCY', cpus + 1))
+
+threads = GUNICORN_THREADS if GUNICORN_WORKER_MODE == 'threaded' else 1
+worker_connections = GUNICORN_WORKER_CONNECTIONS
+
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = timeout
+keepalive = 5
+
+
+def flask_app(server):
+    # Only a preloaded app exists before the worker imports its own
+    return server.app.wsgi() if server.cfg.preload_app else None
+
+
+def pre_fork(server, worker):
+    # Connections the master opened would be shared by every child
+    from models import dispose_engines
+
+    app = flask_app(server)
+    if app is not None:
+        dispose_engines(app)
+
+
+def post_fork(server, worker):
+    # Start the worker with pools of its own whatever the master did since
+    from models import dispose_engines
+
+    app = flask_app(server)
+    if app is not None:
+        dispose_engines(app)
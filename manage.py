@@ -1,8 +1,11 @@
-from flask_script import Manager
+from flask_script import Manager, Command
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, get_shard_set
+from search import rebuild_search_index
+from events import prune_events
+from sharding import each_shard, create_shard_schema
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +13,39 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+class RebuildSearch(Command):
+    "Rebuild the full-text search indexes for actors and movies"
+
+    def run(self):
+        each_shard(rebuild_search_index)
+
+
+manager.add_command('rebuild_search', RebuildSearch())
+
+
+class PruneEvents(Command):
+    "Delete change feed events older than CHANGE_FEED_RETENTION seconds"
+
+    def run(self):
+        print('Deleted {} events.'.format(prune_events()))
+
+
+manager.add_command('prune_events', PruneEvents())
+
+
+class CreateShards(Command):
+    "Create the actor and movie tables on every shard that lacks them"
+
+    def run(self):
+        shards = get_shard_set()
+
+        for engine in shards.engines if shards is not None else []:
+            create_shard_schema(engine)
+            print('Created the shard tables on {}.'.format(engine.url))
+
+
+manager.add_command('create_shards', CreateShards())
+
+
 if __name__ == '__main__':
     manager.run()
@@ -33,6 +33,16 @@ target_metadata = current_app.extensions['migrate'].db.metadata
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # Full-text search tables are managed by hand-written migrations, and
+    # SQLite's own tables, like sqlite_sequence, by SQLite
+    if type_ == 'table' and reflected and compare_to is None and \
+            ('_fts' in name or name.startswith('sqlite_')):
+        return False
+
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -83,6 +93,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,113 @@
+"""Normalize Movie.cast into the movie_actors association table
+
+Revision ID: 5b1e7c2d9a40
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e7c2d9a40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The actors and movies tables predate migrations (db.create_all), and
+    # create_all may already have added an empty movie_actors table
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+
+    # Fresh databases start from the schema create_all used to build
+    if 'actors' not in inspector.get_table_names():
+        op.create_table(
+            'actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'movies' not in inspector.get_table_names():
+        op.create_table(
+            'movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'movie_actors' not in inspector.get_table_names():
+        op.create_table(
+            'movie_actors',
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                    ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                    ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+        )
+        op.create_index('ix_movie_actors_actor_id', 'movie_actors',
+                        ['actor_id', 'movie_id'])
+
+    movie_columns = [column['name']
+                     for column in inspector.get_columns('movies')]
+    if 'cast' not in movie_columns:
+        return
+
+    # Convert the comma-joined id strings, dropping ids of deleted actors
+    actor_ids = {row[0] for row in connection.execute(
+        sa.text('SELECT id FROM actors'))}
+    links = set()
+
+    for movie_id, cast in connection.execute(
+            sa.text('SELECT id, "cast" FROM movies WHERE "cast" IS NOT NULL')):
+        for actor_id in cast.split(','):
+            if actor_id.strip().isdigit() and \
+                    int(actor_id) in actor_ids:
+                links.add((movie_id, int(actor_id)))
+
+    # Rebuilding movies drops the old table, which would cascade to any
+    # association rows written before it
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('cast')
+
+    existing = set(connection.execute(
+        sa.text('SELECT movie_id, actor_id FROM movie_actors')))
+
+    movie_actors = sa.table('movie_actors',
+                            sa.column('movie_id', sa.Integer),
+                            sa.column('actor_id', sa.Integer))
+    rows = [{'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id, actor_id in sorted(links - existing)]
+    if rows:
+        op.bulk_insert(movie_actors, rows)
+
+
+def downgrade():
+    connection = op.get_bind()
+
+    # Rebuild the comma-joined strings from the association rows, reading
+    # them before movies is altered
+    casts = {}
+    for movie_id, actor_id in connection.execute(sa.text(
+            'SELECT movie_id, actor_id FROM movie_actors '
+            'ORDER BY movie_id, actor_id')):
+        casts.setdefault(movie_id, []).append(str(actor_id))
+
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.add_column(sa.Column('cast', sa.String(), nullable=True))
+
+    for movie_id, actor_ids in casts.items():
+        connection.execute(
+            sa.text('UPDATE movies SET "cast" = :cast WHERE id = :id'),
+            cast=','.join(actor_ids), id=movie_id)
+
+    op.drop_index('ix_movie_actors_actor_id', table_name='movie_actors')
+    op.drop_table('movie_actors')
@@ -0,0 +1,40 @@
+"""Add indexes for list filtering and sorting
+
+Revision ID: 8d3f41b6c2e7
+Revises: 5b1e7c2d9a40
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f41b6c2e7'
+down_revision = '5b1e7c2d9a40'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_actors_gender_age', 'actors', ['gender', 'age']),
+    ('ix_actors_age', 'actors', ['age']),
+    ('ix_actors_name', 'actors', ['name']),
+    ('ix_movies_release_date_id', 'movies', ['release_date', 'id']),
+    ('ix_movies_title', 'movies', ['title']),
+]
+
+
+def upgrade():
+    # Tables created by db.create_all may already carry these indexes
+    inspector = sa.inspect(op.get_bind())
+
+    for name, table, columns in INDEXES:
+        existing = [index['name'] for index in inspector.get_indexes(table)]
+
+        if name not in existing:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,104 @@
+"""Add row versions and tombstones for delta sync
+
+Revision ID: a5d0e3f7b912
+Revises: f2a6c8d94b17
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5d0e3f7b912'
+down_revision = 'f2a6c8d94b17'
+branch_labels = None
+depends_on = None
+
+SYNCED_TABLES = ['actors', 'movies']
+
+# Rebuilding a SQLite table drops its triggers, including the ones that
+# keep the search index of c47a9e05d1f3 in sync
+SEARCH_COLUMNS = {'actors': 'name', 'movies': 'title'}
+
+SQLITE_SEARCH_TRIGGERS = [
+    "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_fts(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+    "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); END",
+    "CREATE TRIGGER {table}_fts_update AFTER UPDATE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); "
+    "INSERT INTO {table}_fts(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+]
+
+
+def upgrade():
+    # create_all may already have added the tombstones table
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+
+    if 'tombstones' not in inspector.get_table_names():
+        op.create_table(
+            'tombstones',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('table_name', sa.String(), nullable=False),
+            sa.Column('row_id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_tombstones_table_name_version', 'tombstones',
+                        ['table_name', 'version'])
+
+    for table in SYNCED_TABLES:
+        columns = [column['name'] for column in inspector.get_columns(table)]
+        if 'row_version' in columns:
+            continue
+
+        op.add_column(table, sa.Column('row_version', sa.Integer(),
+                                       nullable=False, server_default='0'))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                       nullable=True))
+        op.create_index('ix_{}_row_version'.format(table), table,
+                        ['row_version', 'id'])
+
+        # Existing rows get a version above 0 so since=0 returns them
+        connection.execute(sa.text(
+            'UPDATE table_versions SET version = version + 1 '
+            'WHERE name = :name'), name=table)
+        connection.execute(sa.text(
+            'UPDATE {} SET row_version = (SELECT version FROM table_versions '
+            'WHERE name = :name), updated_at = CURRENT_TIMESTAMP'
+            .format(table)), name=table)
+
+
+def downgrade():
+    connection = op.get_bind()
+
+    # Rebuilding actors and movies cascades to the association rows
+    links = [dict(row) for row in connection.execute(
+        sa.text('SELECT movie_id, actor_id FROM movie_actors'))]
+
+    for table in SYNCED_TABLES:
+        op.drop_index('ix_{}_row_version'.format(table), table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('row_version')
+
+    connection.execute(sa.text('DELETE FROM movie_actors'))
+    if links:
+        op.bulk_insert(sa.table('movie_actors',
+                                sa.column('movie_id', sa.Integer),
+                                sa.column('actor_id', sa.Integer)), links)
+
+    if connection.dialect.name == 'sqlite':
+        for table, column in SEARCH_COLUMNS.items():
+            for statement in SQLITE_SEARCH_TRIGGERS:
+                op.execute(statement.format(table=table, column=column))
+
+    op.drop_index('ix_tombstones_table_name_version', table_name='tombstones')
+    op.drop_table('tombstones')
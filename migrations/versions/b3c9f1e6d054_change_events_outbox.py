@@ -0,0 +1,38 @@
+"""Add the change_events outbox for the SSE change feed
+
+Revision ID: b3c9f1e6d054
+Revises: a5d0e3f7b912
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3c9f1e6d054'
+down_revision = 'a5d0e3f7b912'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_all may already have added the table
+    inspector = sa.inspect(op.get_bind())
+
+    if 'change_events' not in inspector.get_table_names():
+        op.create_table(
+            'change_events',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('table_name', sa.String(), nullable=False),
+            sa.Column('row_id', sa.Integer(), nullable=False),
+            sa.Column('action', sa.String(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sqlite_autoincrement=True
+        )
+
+
+def downgrade():
+    op.drop_table('change_events')
@@ -0,0 +1,84 @@
+"""Add full-text search indexes over actor names and movie titles
+
+Revision ID: c47a9e05d1f3
+Revises: 8d3f41b6c2e7
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a9e05d1f3'
+down_revision = '8d3f41b6c2e7'
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = [('actors', 'name'), ('movies', 'title')]
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE {table}_fts USING fts5("
+    "{column}, content='{table}', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_fts(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+    "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); END",
+    "CREATE TRIGGER {table}_fts_update AFTER UPDATE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); "
+    "INSERT INTO {table}_fts(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+    "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER {table}_fts_update",
+    "DROP TRIGGER {table}_fts_delete",
+    "DROP TRIGGER {table}_fts_insert",
+    "DROP TABLE {table}_fts",
+]
+
+POSTGRES_UPGRADE = [
+    "ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce({column}, ''))) "
+    "STORED",
+    "CREATE INDEX ix_{table}_search_vector ON {table} "
+    "USING GIN (search_vector)",
+]
+
+POSTGRES_DOWNGRADE = [
+    "DROP INDEX ix_{table}_search_vector",
+    "ALTER TABLE {table} DROP COLUMN search_vector",
+]
+
+
+def upgrade():
+    # Tables created by db.create_all already carry the search objects
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+    postgres = connection.dialect.name == 'postgresql'
+
+    for table, column in SEARCH_COLUMNS:
+        if postgres:
+            columns = [info['name'] for info in inspector.get_columns(table)]
+            exists = 'search_vector' in columns
+
+        else:
+            exists = table + '_fts' in inspector.get_table_names()
+
+        if not exists:
+            for statement in POSTGRES_UPGRADE if postgres else SQLITE_UPGRADE:
+                op.execute(statement.format(table=table, column=column))
+
+
+def downgrade():
+    postgres = op.get_bind().dialect.name == 'postgresql'
+
+    for table, column in SEARCH_COLUMNS:
+        for statement in POSTGRES_DOWNGRADE if postgres \
+                else SQLITE_DOWNGRADE:
+            op.execute(statement.format(table=table, column=column))
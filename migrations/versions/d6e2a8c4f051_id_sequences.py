@@ -0,0 +1,43 @@
+"""Add id_sequences for globally unique ids across shards
+
+Revision ID: d6e2a8c4f051
+Revises: b3c9f1e6d054
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6e2a8c4f051'
+down_revision = 'b3c9f1e6d054'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_all may already have added the table
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+
+    if 'id_sequences' in inspector.get_table_names():
+        return
+
+    id_sequences = op.create_table(
+        'id_sequences',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('next_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+    # Start past the rows already on the primary, so they can be moved to
+    # shards without their ids being handed out again
+    op.bulk_insert(id_sequences, [
+        {'name': name, 'next_id': connection.execute(sa.text(
+            'SELECT COALESCE(MAX(id), 0) + 1 FROM {}'.format(name))).scalar()}
+        for name in ('actors', 'movies')])
+
+
+def downgrade():
+    op.drop_table('id_sequences')
@@ -0,0 +1,47 @@
+"""Add per-table change versions for response cache invalidation
+
+Revision ID: e91b5d3a7c28
+Revises: c47a9e05d1f3
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e91b5d3a7c28'
+down_revision = 'c47a9e05d1f3'
+branch_labels = None
+depends_on = None
+
+VERSIONED_TABLES = ['actors', 'movies']
+
+
+def upgrade():
+    # create_all may already have added and seeded the table
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+
+    if 'table_versions' not in inspector.get_table_names():
+        op.create_table(
+            'table_versions',
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('name')
+        )
+
+    existing = {row[0] for row in connection.execute(
+        sa.text('SELECT name FROM table_versions'))}
+
+    table_versions = sa.table('table_versions',
+                              sa.column('name', sa.String),
+                              sa.column('version', sa.Integer))
+    rows = [{'name': name, 'version': 0}
+            for name in VERSIONED_TABLES if name not in existing]
+    if rows:
+        op.bulk_insert(table_versions, rows)
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,36 @@
+"""Record when each table last changed for Last-Modified headers
+
+Revision ID: f2a6c8d94b17
+Revises: e91b5d3a7c28
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a6c8d94b17'
+down_revision = 'e91b5d3a7c28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # create_all may already have added the column
+    connection = op.get_bind()
+    columns = [column['name'] for column in
+               sa.inspect(connection).get_columns('table_versions')]
+
+    if 'changed_at' not in columns:
+        op.add_column('table_versions',
+                      sa.Column('changed_at', sa.DateTime(), nullable=True))
+
+    connection.execute(
+        sa.text('UPDATE table_versions SET changed_at = CURRENT_TIMESTAMP '
+                'WHERE changed_at IS NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('table_versions') as batch_op:
+        batch_op.drop_column('changed_at')
@@ -1,7 +1,15 @@
 import os
 import json
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+import datetime
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, \
+    Index, create_engine, event, func, orm, select, text, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.util import find_tables
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,7 +18,79 @@ local_database_path = "sqlite:///{}".format(os.path.join(project_dir,
 
 database_path = os.environ.get('DATABASE_URL', local_database_path)
 
-db = SQLAlchemy()
+# Migrations own the schema; create_all is a development shortcut
+DB_CREATE_ALL = os.getenv('DB_CREATE_ALL') == '1'
+
+# Engine profile; 'default' leaves SQLAlchemy's own settings alone
+DB_PROFILE = os.getenv('DB_PROFILE', 'tuned')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 30000))
+
+SQLITE_PRAGMAS = [
+    ('journal_mode', os.getenv('SQLITE_JOURNAL_MODE', 'WAL')),
+    ('synchronous', os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')),
+    ('busy_timeout', int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))),
+    # Negative sizes are in KiB
+    ('cache_size', int(os.getenv('SQLITE_CACHE_SIZE', -65536))),
+    ('mmap_size', int(os.getenv('SQLITE_MMAP_SIZE', 268435456))),
+]
+
+
+class RoutingSession(SignallingSession):
+    # Sharded tables go to the shard in use; other reads go wherever the
+    # app's read router sends them; flushes, and apps without replicas or
+    # shards, use the primary
+
+    def __init__(self, db, **options):
+        self.shards = db.get_app().extensions.get('shards')
+
+        if self.shards is not None:
+            # Nothing would say which shard to reload expired rows from
+            options['expire_on_commit'] = False
+            self.connection_callable = self.shard_connection
+
+        SignallingSession.__init__(self, db, **options)
+
+    def is_sharded(self, mapper, clause):
+        if mapper is not None:
+            return mapper.local_table.name in self.shards.tables
+
+        return clause is not None and any(
+            table.name in self.shards.tables
+            for table in find_tables(clause, include_crud=True))
+
+    def shard_connection(self, mapper, instance):
+        # Flushed rows go to the shard their id hashes to
+        if mapper.local_table.name in self.shards.tables:
+            return self.connection(bind=self.shards.for_id(instance.id))
+
+        return self.connection(mapper=mapper)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.shards is not None and self.is_sharded(mapper, clause):
+            return self.shards.current()
+
+        router = self.app.extensions.get('read_router')
+
+        if router is not None and not self._flushing:
+            engine = router.read_bind()
+
+            if engine is not None:
+                return engine
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
@@ -19,21 +99,653 @@ setup_db(app)
 
 
 def setup_db(app, database_path=database_path):
+    profile = app.config.get('DB_PROFILE', DB_PROFILE)
+
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(database_path, profile))
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+    if profile == 'tuned' and make_url(database_path).drivername == 'sqlite':
+        event.listen(db.get_engine(app), 'connect', apply_sqlite_pragmas)
+
+    # Nothing connects to the database until the first query
+    if app.config.get('DB_CREATE_ALL', DB_CREATE_ALL):
+        db.create_all()
+
+
+'''
+dispose_engines(app)
+    drops the pooled connections of every engine the app has opened, so
+    a forked process starts with empty pools of its own
+'''
+
+
+def dispose_engines(app):
+    for connector in app.extensions['sqlalchemy'].connectors.values():
+        connector.get_engine().dispose()
+
+    for name in ('read_router', 'shards'):
+        extension = app.extensions.get(name)
+        for engine in extension.engines if extension is not None else []:
+            engine.dispose()
+
+
+'''
+make_engine(database_path, profile)
+    creates an engine outside Flask-SQLAlchemy with the same profile as
+    the primary, for replicas and shards
+'''
+
+
+def make_engine(database_path, profile=DB_PROFILE):
+    engine = create_engine(database_path,
+                           **engine_options(database_path, profile))
+
+    if profile == 'tuned' and make_url(database_path).drivername == 'sqlite':
+        event.listen(engine, 'connect', apply_sqlite_pragmas)
+
+    return engine
+
+
+def get_shard_set():
+    # The app's shards when actors and movies are sharded, otherwise None
+    return db.get_app().extensions.get('shards')
+
+
+'''
+engine_options(database_path, profile)
+    returns the create_engine arguments of the profile for the database
+'''
+
+
+def engine_options(database_path, profile=DB_PROFILE):
+    url = make_url(database_path)
+
+    if profile != 'tuned':
+        return {}
+
+    if url.get_backend_name() == 'postgresql':
+        options = {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING
+        }
+
+        if DB_STATEMENT_TIMEOUT:
+            options['connect_args'] = {
+                'options': '-c statement_timeout={}'.format(
+                    DB_STATEMENT_TIMEOUT)}
+
+        return options
+
+    # Keep SQLite file connections open instead of reconnecting per checkout
+    if url.get_backend_name() == 'sqlite' and \
+            url.database not in (None, '', ':memory:'):
+        return {
+            'poolclass': QueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'connect_args': {'check_same_thread': False}
+        }
+
+    return {}
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside a writer instead of waiting on it
+    for name, value in SQLITE_PRAGMAS:
+        dbapi_connection.execute('PRAGMA {}={}'.format(name, value))
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces ON DELETE CASCADE with this pragma set
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+def supports_returning(bind):
+    # SQLite has RETURNING from 3.35; older versions use the fallback path
+    if bind.dialect.name == 'postgresql':
+        return True
+
+    return bind.dialect.name == 'sqlite' and \
+        sqlite3.sqlite_version_info >= (3, 35)
+
+
+'''
+insert_many(model, rows)
+    inserts a list of column dicts in one statement and one commit,
+    returning the new ids in the same order as rows
+'''
+
+
+def insert_many(model, rows):
+    if not rows:
+        return []
+
+    table = model.__table__
+
+    if get_shard_set() is not None:
+        ids, stamp = insert_sharded(model, rows)
+        add_events(model.__tablename__, 'create', ids, stamp['row_version'])
+        db.session.commit()
+        return ids
+
+    # One version for the whole batch
+    stamp = stamp_row(model.__tablename__)
+    for row in rows:
+        row.update(stamp)
+
+    # Postgres returns every generated id from one multi-row INSERT
+    if db.session.get_bind(model.__mapper__).dialect.name == 'postgresql':
+        result = db.session.execute(
+            table.insert().values(rows).returning(table.c.id))
+        ids = [row[0] for row in result]
+
+    # The version stamp holds SQLite's write lock until commit, so the ids
+    # after the current maximum stay free; SQLite would pick the same ones
+    elif db.session.get_bind(model.__mapper__).dialect.name == 'sqlite':
+        first_id = db.session.execute(
+            select([func.coalesce(func.max(table.c.id), 0) + 1]),
+            mapper=model.__mapper__).scalar()
+
+        ids = list(range(first_id, first_id + len(rows)))
+        for row, row_id in zip(rows, ids):
+            row['id'] = row_id
+
+        db.session.execute(table.insert(), rows, mapper=model.__mapper__)
+
+    # Other databases fetch each generated id with an INSERT per row
+    else:
+        db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+        ids = [row['id'] for row in rows]
+
+    add_events(model.__tablename__, 'create', ids, stamp['row_version'])
+    db.session.commit()
+    return ids
+
+
+def insert_sharded(model, rows):
+    # Returns the ids and the version stamp of rows inserted on their shards
+    shards = get_shard_set()
+
+    while True:
+        # Global ids come before the version row is locked
+        ids = shards.allocate(model.__tablename__, len(rows))
+        stamp = stamp_row(model.__tablename__)
+        for row, row_id in zip(rows, ids):
+            row.update(stamp, id=row_id)
+
+        try:
+            for engine, group in shards.group(rows, lambda row: row['id']):
+                with shards.using(engine):
+                    # Bulk mappings refuse per-instance sharding
+                    db.session.execute(model.__table__.insert(), group,
+                                       mapper=model.__mapper__)
+
+            return ids, stamp
+
+        except IntegrityError:
+            # Another worker let a client take one of these ids; the next
+            # allocation always comes after it
+            db.session.rollback()
+
+            if not ids_taken(model, ids):
+                raise
+
+
+'''
+ids_taken(model, ids)
+    returns whether a row already exists on its shard for any of the ids
+'''
+
+
+def ids_taken(model, ids):
+    shards = get_shard_set()
+
+    for engine, group in shards.group(ids):
+        with shards.using(engine):
+            if db.session.query(model.id).filter(
+                    model.id.in_(group)).first() is not None:
+                return True
+
+    return False
+
+
+'''
+add_row(row)
+    adds and flushes a new actor or movie and returns its version; on
+    shards, an allocated id a client already took is passed over
+'''
+
+
+def add_row(row):
+    shards = get_shard_set()
+
+    while True:
+        # Sharded rows need their global id before anything is written
+        allocated = shards is not None and row.id is None
+        if allocated:
+            row.id = shards.allocate(row.__tablename__, 1)[0]
+
+        version = row.stamp()
+        db.session.add(row)
+
+        try:
+            db.session.flush()
+            return version
+
+        except IntegrityError:
+            db.session.rollback()
+
+            if not allocated or not ids_taken(type(row), [row.id]):
+                raise
+
+            row.id = None
+
+
+'''
+update_row(model, row_id, values, commit, touch)
+    updates whitelisted columns of one row with a single UPDATE ... RETURNING
+    and returns the updated row, or None if no row has that id; touch gives
+    the row a new version even without column changes
+'''
+
+
+def update_row(model, row_id, values, commit=True, touch=False):
+    table = model.__table__
+    bind = db.session.get_bind(model.__mapper__)
+
+    if values or touch:
+        values = dict(values, **stamp_row(model.__tablename__))
+
+    if not values:
+        row = db.session.execute(
+            select([table]).where(table.c.id == row_id)).first()
+
+    elif supports_returning(bind):
+        # Only whitelisted column names ever reach this statement
+        quote = bind.dialect.identifier_preparer.quote
+        statement = text('UPDATE {} SET {} WHERE id = :id RETURNING {}'.format(
+            quote(table.name),
+            ', '.join('{} = :{}'.format(quote(name), name) for name in values),
+            ', '.join(quote(column.name) for column in table.c)))
+        statement = statement.bindparams(
+            *[bindparam(name, type_=table.c[name].type) for name in values]
+        ).columns(*table.c)
+
+        row = db.session.execute(statement, dict(values, id=row_id),
+                                 mapper=model.__mapper__).first()
+
+    else:
+        result = db.session.execute(
+            table.update().where(table.c.id == row_id).values(**values))
+        row = None
+
+        if result.rowcount:
+            row = db.session.execute(
+                select([table]).where(table.c.id == row_id)).first()
+
+    # A missing row leaves the table version, and so every cache, as it was
+    if row is None:
+        db.session.rollback()
+        return None
+
+    if values:
+        add_events(model.__tablename__, 'update', [row_id],
+                   values['row_version'])
+
+    if commit:
+        db.session.commit()
+
+    return row
+
+
+'''
+insert_if_absent(model, values)
+    inserts one row with an explicit id using INSERT ... ON CONFLICT DO
+    NOTHING and returns whether this call created it
+'''
+
+
+def insert_if_absent(model, values):
+    table = model.__table__
+    bind = db.session.get_bind(model.__mapper__)
+    quote = bind.dialect.identifier_preparer.quote
+    shards = get_shard_set()
+
+    # Keep the id allocator from handing out an id a client chose
+    if shards is not None:
+        shards.skip(model.__tablename__, values['id'])
+
+    values = dict(values, **stamp_row(model.__tablename__))
+
+    # SQLite learned ON CONFLICT in 3.24; older versions use OR IGNORE
+    if bind.dialect.name == 'sqlite' and \
+            sqlite3.sqlite_version_info < (3, 24):
+        sql = 'INSERT OR IGNORE INTO {} ({}) VALUES ({})'
+
+    else:
+        sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id) DO NOTHING'
+
+    statement = text(sql.format(
+        quote(table.name),
+        ', '.join(quote(name) for name in values),
+        ', '.join(':' + name for name in values)))
+    statement = statement.bindparams(
+        *[bindparam(name, type_=table.c[name].type) for name in values])
+
+    result = db.session.execute(statement, values, mapper=model.__mapper__)
+    created = result.rowcount == 1
+
+    # Keep the version unchanged when the row already existed
+    if created:
+        add_events(model.__tablename__, 'create', [values['id']],
+                   values['row_version'])
+        db.session.commit()
+
+    else:
+        db.session.rollback()
+
+    return created
+
+
+'''
+delete_row(model, row_id)
+    deletes one row with a single DELETE statement and returns whether it
+    existed; dependent association rows go with it through ON DELETE CASCADE
+'''
+
+
+def delete_row(model, row_id):
+    table = model.__table__
+    version = stamp_row(model.__tablename__)['row_version']
+
+    # Movies lose the actor from their cast through the cascade
+    if model.__tablename__ == 'actors':
+        unlink_actor(row_id)
+
+    result = db.session.execute(table.delete().where(table.c.id == row_id))
+    deleted = result.rowcount > 0
+
+    if deleted:
+        add_tombstone(model.__tablename__, row_id, version)
+        add_events(model.__tablename__, 'delete', [row_id], version)
+        db.session.commit()
+
+    else:
+        db.session.rollback()
+
+    return deleted
+
+
+# Change Tracking
+table_versions = db.Table(
+    'table_versions',
+    Column('name', String, primary_key=True),
+    Column('version', Integer, nullable=False, default=0),
+    Column('changed_at', DateTime, nullable=True)
+)
+
+VERSIONED_TABLES = ('actors', 'movies')
+
+
+@event.listens_for(table_versions, 'after_create')
+def seed_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'version': 0, 'changed_at': datetime.datetime.utcnow()}
+        for name in VERSIONED_TABLES])
+
+
+'''
+bump_versions(*names)
+    increments the change version of each table inside the current
+    transaction, so the new version commits together with the write
+'''
+
+
+def bump_versions(*names):
+    db.session.execute(table_versions.update()
+                       .where(table_versions.c.name.in_(names))
+                       .values(version=table_versions.c.version + 1,
+                               changed_at=datetime.datetime.utcnow()))
+
+    return get_versions(*names)
+
+
+def stamp_row(name):
+    # Row version and timestamp for a row written in the current transaction
+    return {'row_version': bump_versions(name)[name],
+            'updated_at': datetime.datetime.utcnow()}
+
+
+def get_versions(*names):
+    return get_table_state(*names)[0]
+
+
+'''
+get_table_state(*names)
+    returns the change versions of the tables and the UTC time of the
+    latest change to any of them, read with one query
+'''
+
+
+def get_table_state(*names):
+    rows = db.session.execute(
+        select([table_versions.c.name, table_versions.c.version,
+                table_versions.c.changed_at])
+        .where(table_versions.c.name.in_(names))).fetchall()
+
+    changes = [row.changed_at for row in rows if row.changed_at is not None]
+
+    return {row.name: row.version for row in rows}, \
+        max(changes) if changes else None
+
+
+# Next unallocated id of each sharded table, kept on the primary
+id_sequences = db.Table(
+    'id_sequences',
+    Column('name', String, primary_key=True),
+    Column('next_id', Integer, nullable=False)
+)
+
+
+@event.listens_for(id_sequences, 'after_create')
+def seed_id_sequences(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'next_id': 1} for name in VERSIONED_TABLES])
+
+
+'''
+reserve_ids(name, count)
+    reserves count consecutive ids of the table and returns the first;
+    commits on its own connection, so a reserved block is never handed
+    out twice even if the write using it rolls back
+'''
+
+
+def reserve_ids(name, count):
+    with db.get_engine(db.get_app()).begin() as connection:
+        connection.execute(id_sequences.update()
+                           .where(id_sequences.c.name == name)
+                           .values(next_id=id_sequences.c.next_id + count))
+
+        return connection.execute(
+            select([id_sequences.c.next_id])
+            .where(id_sequences.c.name == name)).scalar() - count
+
+
+def skip_ids(name, row_id):
+    # Move the sequence past an id a client chose itself
+    with db.get_engine(db.get_app()).begin() as connection:
+        connection.execute(id_sequences.update()
+                           .where(id_sequences.c.name == name)
+                           .where(id_sequences.c.next_id <= row_id)
+                           .values(next_id=row_id + 1))
+
+
+# Deleted rows, kept so delta sync clients can drop them
+tombstones = db.Table(
+    'tombstones',
+    Column('id', Integer, primary_key=True),
+    Column('table_name', String, nullable=False),
+    Column('row_id', Integer, nullable=False),
+    Column('version', Integer, nullable=False),
+    Column('deleted_at', DateTime, nullable=False),
+    Index('ix_tombstones_table_name_version', 'table_name', 'version')
+)
+
+
+def add_tombstone(name, row_id, version):
+    db.session.execute(tombstones.insert().values(
+        table_name=name, row_id=row_id, version=version,
+        deleted_at=datetime.datetime.utcnow()))
+
+
+'''
+get_deleted_ids(name, since)
+    returns the ids of rows of the table deleted after version since
+'''
+
+
+def get_deleted_ids(name, since):
+    return [row[0] for row in db.session.execute(
+        select([tombstones.c.row_id])
+        .where(tombstones.c.table_name == name)
+        .where(tombstones.c.version > since)
+        .order_by(tombstones.c.version, tombstones.c.row_id))]
+
+
+# Outbox of row changes, written in the same transaction as the change
+change_events = db.Table(
+    'change_events',
+    Column('id', Integer, primary_key=True),
+    Column('table_name', String, nullable=False),
+    Column('row_id', Integer, nullable=False),
+    Column('action', String, nullable=False),
+    Column('version', Integer, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    # Ids are never reused on SQLite, even after pruning
+    sqlite_autoincrement=True
+)
+
+
+# Called with the table name and row ids of every update and delete
+row_change_listeners = []
+
+
+def add_events(name, action, row_ids, version):
+    if not row_ids:
+        return
+
+    created_at = datetime.datetime.utcnow()
+    db.session.execute(change_events.insert(), [
+        {'table_name': name, 'row_id': row_id, 'action': action,
+         'version': version, 'created_at': created_at}
+        for row_id in row_ids])
+
+    if action != 'create':
+        for listener in row_change_listeners:
+            listener(name, row_ids)
+
+
+# Association Tables
+movie_actors = db.Table(
+    'movie_actors',
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    # Reverse index for "which movies is this actor in" lookups
+    Index('ix_movie_actors_actor_id', 'actor_id', 'movie_id')
+)
+
+
+'''
+set_cast(movie_id, actor_ids)
+    replaces the cast of a movie without loading the movie; the caller
+    stamps the movie, together with any other change to it
+'''
+
+
+def set_cast(movie_id, actor_ids):
+    db.session.execute(movie_actors.delete().where(
+        movie_actors.c.movie_id == movie_id))
+
+    if actor_ids:
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for actor_id in actor_ids])
+
+
+def touch_movies_with_actor(actor_id):
+    # Give every movie casting the actor a new version before it is deleted
+    movie_ids = [row[0] for row in db.session.execute(
+        select([movie_actors.c.movie_id])
+        .where(movie_actors.c.actor_id == actor_id))]
+
+    if not movie_ids:
+        return
+
+    stamp = stamp_row('movies')
+    db.session.execute(Movie.__table__.update()
+                       .where(Movie.id.in_(movie_ids))
+                       .values(**stamp))
+    add_events('movies', 'update', movie_ids, stamp['row_version'])
+
+
+def unlink_actor(actor_id):
+    # Shards keep a movie's links with the movie, out of reach of the
+    # actor's ON DELETE CASCADE, so they are removed on every shard here
+    shards = get_shard_set()
+
+    if shards is None:
+        touch_movies_with_actor(actor_id)
+        return
+
+    for engine in shards.engines:
+        with shards.using(engine):
+            touch_movies_with_actor(actor_id)
+            db.session.execute(movie_actors.delete().where(
+                movie_actors.c.actor_id == actor_id))
+
+
+def format_cast(actor_ids):
+    # Comma-joined id string used for Movie.cast in API responses
+    if not actor_ids:
+        return None
+
+    return ','.join(str(actor_id) for actor_id in sorted(actor_ids))
+
+
+def get_cast_ids(movie_id):
+    return [row[0] for row in db.session.execute(
+        select([movie_actors.c.actor_id])
+        .where(movie_actors.c.movie_id == movie_id))]
 
 
 # Classes
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        # Indexes backing the list filters and sort keys
+        Index('ix_actors_gender_age', 'gender', 'age'),
+        Index('ix_actors_age', 'age'),
+        Index('ix_actors_name', 'name'),
+        Index('ix_actors_row_version', 'row_version', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
+    row_version = Column(Integer, nullable=False, server_default='0')
+    updated_at = Column(DateTime)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -41,16 +753,29 @@ class Actor(db.Model):
         self.gender = gender
 
     def insert(self):
-        db.session.add(self)
+        version = add_row(self)
+        add_events(self.__tablename__, 'create', [self.id], version)
         db.session.commit()
 
     def update(self):
+        version = self.stamp()
+        add_events(self.__tablename__, 'update', [self.id], version)
         db.session.commit()
 
     def delete(self):
+        unlink_actor(self.id)
+        version = self.stamp()
+        add_tombstone(self.__tablename__, self.id, version)
+        add_events(self.__tablename__, 'delete', [self.id], version)
         db.session.delete(self)
         db.session.commit()
 
+    def stamp(self):
+        for name, value in stamp_row(self.__tablename__).items():
+            setattr(self, name, value)
+
+        return self.row_version
+
     def format(self):
         return {
             'id': self.id,
@@ -62,31 +787,70 @@ class Actor(db.Model):
 
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        # Indexes backing the list filters and sort keys
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+        Index('ix_movies_title', 'title'),
+        Index('ix_movies_row_version', 'row_version', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(db.DateTime, nullable=False)
-    cast = Column(String)
+    row_version = Column(Integer, nullable=False, server_default='0')
+    updated_at = Column(DateTime)
+
+    # Cast members are loaded for a whole result set with one IN query
+    actors = db.relationship(
+        'Actor',
+        secondary=movie_actors,
+        order_by='Actor.id',
+        lazy='selectin',
+        backref=db.backref('movies', lazy='select'))
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
     def insert(self):
-        db.session.add(self)
+        version = add_row(self)
+        add_events(self.__tablename__, 'create', [self.id], version)
         db.session.commit()
 
     def update(self):
+        version = self.stamp()
+        add_events(self.__tablename__, 'update', [self.id], version)
         db.session.commit()
 
     def delete(self):
+        version = self.stamp()
+        add_tombstone(self.__tablename__, self.id, version)
+        add_events(self.__tablename__, 'delete', [self.id], version)
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
+    def stamp(self):
+        for name, value in stamp_row(self.__tablename__).items():
+            setattr(self, name, value)
+
+        return self.row_version
+
+    @property
+    def cast(self):
+        # Same comma-joined id string the API returned before normalization
+        return format_cast([actor.id for actor in self.actors])
+
+    def format(self, expand=()):
+        # expand=('cast',) embeds the actors instead of their id string
+        if 'cast' in expand:
+            cast = [actor.format() for actor in self.actors]
+
+        else:
+            cast = self.cast
+
         return {
             'id': self.id,
             'title': self.title,
             'release date': self.release_date,
-            'cast': self.cast
+            'cast': cast
         }
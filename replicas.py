@@ -0,0 +1,152 @@
+'''
+Read replica routing.
+
+GET and HEAD requests read from a replica engine, chosen round-robin once
+per request so every query of a request sees the same snapshot. All other
+requests, and anything a session flushes, use the primary.
+
+A client that has just written is pinned to the primary for
+READ_YOUR_WRITES_WINDOW seconds, so it does not read a replica that has
+not caught up with its own write yet. The pin travels in a cookie, which
+any worker honours, and is also kept per token subject in-process for
+clients that do not send cookies back.
+'''
+import os
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, g, has_request_context, \
+    _request_ctx_stack
+from models import DB_PROFILE, make_engine
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv(
+    'DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+PIN_COOKIE = 'db_primary_until'
+PIN_TABLE_SIZE = 10000
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def auth_subject():
+    # Set by requires_auth once the token has been verified
+    payload = getattr(_request_ctx_stack.top, 'current_user', None)
+    return payload.get('sub') if payload else None
+
+
+def pinned_by_cookie():
+    try:
+        return float(request.cookies.get(PIN_COOKIE, 0)) > time.time()
+
+    except ValueError:
+        return False
+
+
+class ReadRouter:
+
+    def __init__(self, engines, window=READ_YOUR_WRITES_WINDOW):
+        self.engines = engines
+        self.window = window
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+        self._next = 0
+        self._pins = OrderedDict()
+        self._lock = threading.Lock()
+
+    def choose(self):
+        # Round-robin over the replicas
+        with self._lock:
+            engine = self.engines[self._next % len(self.engines)]
+            self._next += 1
+
+        return engine
+
+    def pin(self, subject):
+        with self._lock:
+            self._pins[subject] = time.time() + self.window
+            self._pins.move_to_end(subject)
+
+            while len(self._pins) > PIN_TABLE_SIZE:
+                self._pins.popitem(last=False)
+
+    def is_pinned(self, subject):
+        deadline = self._pins.get(subject)
+        return deadline is not None and deadline > time.time()
+
+    def read_bind(self):
+        '''
+        read_bind()
+            returns the replica engine the current request reads from, or
+            None when it must use the primary
+        '''
+        if not has_request_context():
+            return None
+
+        # Decided on the first query, after requires_auth has run
+        if 'read_bind' not in g:
+            if request.method not in SAFE_METHODS or g.get('use_primary') \
+                    or pinned_by_cookie() or self.is_pinned(auth_subject()):
+                g.read_bind = None
+                self.primary_reads += 1
+
+            else:
+                g.read_bind = self.choose()
+                self.replica_reads += 1
+
+        return g.read_bind
+
+    def stats(self):
+        return {
+            'replicas': len(self.engines),
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'pins': len(self._pins)
+        }
+
+
+def use_primary(f):
+    '''
+    use_primary(f)
+        makes a GET handler read from the primary, for reads that must not
+        lag behind writes
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.use_primary = True
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def pin_writer(response):
+    # Successful writes pin their client to the primary for a while
+    router = current_app.extensions['read_router']
+
+    if request.method not in SAFE_METHODS and response.status_code < 400:
+        deadline = time.time() + router.window
+        response.set_cookie(PIN_COOKIE, '{:.3f}'.format(deadline),
+                            max_age=router.window, httponly=True,
+                            samesite='Lax')
+
+        subject = auth_subject()
+        if subject is not None:
+            router.pin(subject)
+
+    return response
+
+
+def init_read_replicas(app):
+    urls = app.config.get('SQLALCHEMY_REPLICA_URIS', DATABASE_REPLICA_URLS)
+
+    if not urls:
+        return
+
+    profile = app.config.get('DB_PROFILE', DB_PROFILE)
+    app.extensions['read_router'] = ReadRouter(
+        [make_engine(url, profile) for url in urls],
+        app.config.get('READ_YOUR_WRITES_WINDOW', READ_YOUR_WRITES_WINDOW))
+    app.after_request(pin_writer)
@@ -0,0 +1,143 @@
+'''
+Full-text search over Actor.name and Movie.title.
+
+SQLite keeps an external-content FTS5 table per model in sync with
+triggers. Postgres keeps a generated tsvector column with a GIN index.
+Both are created together with the tables, and by the migrations for
+databases that predate them.
+'''
+import re
+
+from sqlalchemy import DDL, event, text
+
+from models import db, Actor, Movie
+
+# Searchable column for each model
+SEARCH_COLUMNS = {Actor: 'name', Movie: 'title'}
+
+SQLITE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE {table}_fts USING fts5("
+    "{column}, content='{table}', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_fts(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+    "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); END",
+    "CREATE TRIGGER {table}_fts_update AFTER UPDATE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); "
+    "INSERT INTO {table}_fts(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+]
+
+POSTGRES_SEARCH_DDL = [
+    "ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce({column}, ''))) "
+    "STORED",
+    "CREATE INDEX ix_{table}_search_vector ON {table} "
+    "USING GIN (search_vector)",
+]
+
+# Lower scores rank first on both databases
+SQLITE_SEARCH_QUERY = '''
+    SELECT id, score FROM (
+        SELECT rowid AS id, bm25({table}_fts) AS score
+        FROM {table}_fts WHERE {table}_fts MATCH :match)
+    {seek}
+    ORDER BY score, id
+    LIMIT :limit
+'''
+
+POSTGRES_SEARCH_QUERY = '''
+    SELECT id, score FROM (
+        SELECT id, -ts_rank(search_vector, to_tsquery('simple', :match))
+            AS score
+        FROM {table}
+        WHERE search_vector @@ to_tsquery('simple', :match)) AS matches
+    {seek}
+    ORDER BY score, id
+    LIMIT :limit
+'''
+
+SEEK_CLAUSE = 'WHERE score > :score OR (score = :score AND id > :id)'
+
+
+for model, column in SEARCH_COLUMNS.items():
+    for statement in SQLITE_SEARCH_DDL:
+        event.listen(model.__table__, 'after_create', DDL(statement.format(
+            table=model.__tablename__, column=column
+        )).execute_if(dialect='sqlite'))
+
+    for statement in POSTGRES_SEARCH_DDL:
+        event.listen(model.__table__, 'after_create', DDL(statement.format(
+            table=model.__tablename__, column=column
+        )).execute_if(dialect='postgresql'))
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def match_expression(dialect_name, terms):
+    # Every term is a prefix so results update as the user types
+    if dialect_name == 'postgresql':
+        return ' & '.join(term + ':*' for term in terms)
+
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+
+'''
+search(model, query, limit, after)
+    returns up to limit (score, row) pairs matching every term of query,
+    best match first, starting after the (score, id) pair in after
+'''
+
+
+def search(model, query, limit, after=None):
+    dialect_name = db.session.get_bind(model.__mapper__).dialect.name
+    template = POSTGRES_SEARCH_QUERY if dialect_name == 'postgresql' \
+        else SQLITE_SEARCH_QUERY
+
+    params = {
+        'match': match_expression(dialect_name, search_terms(query)),
+        'limit': limit
+    }
+    if after is not None:
+        params['score'], params['id'] = after
+
+    matches = db.session.execute(text(template.format(
+        table=model.__tablename__,
+        seek=SEEK_CLAUSE if after is not None else '')), params,
+        mapper=model.__mapper__).fetchall()
+
+    # Load the matching rows with one IN query and keep the ranking order
+    rows = {row.id: row for row in model.query.filter(
+        model.id.in_([match.id for match in matches]))}
+
+    return [(match.score, rows[match.id]) for match in matches
+            if match.id in rows]
+
+
+'''
+rebuild_search_index()
+    rebuilds the full-text indexes from the base tables of the current
+    database or shard
+'''
+
+
+def rebuild_search_index():
+    dialect_name = db.session.get_bind(Actor.__mapper__).dialect.name
+
+    for model in SEARCH_COLUMNS:
+        if dialect_name == 'postgresql':
+            db.session.execute('REINDEX INDEX ix_{}_search_vector'.format(
+                model.__tablename__), mapper=model.__mapper__)
+
+        else:
+            db.session.execute(
+                "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(
+                    model.__tablename__), mapper=model.__mapper__)
+
+    db.session.commit()
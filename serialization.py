@@ -0,0 +1,125 @@
+'''
+JSON serialization for API responses.
+
+jsonify here replaces flask.jsonify. It encodes through a provider chosen
+once per app: orjson when it is installed, otherwise the stdlib encoder.
+Both providers write datetimes and dates as ISO-8601 strings.
+'''
+import os
+import json
+import uuid
+import datetime
+
+from flask import current_app
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # Optional accelerator; the stdlib path is always there
+    orjson = None
+
+JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'auto')
+
+
+def default(value):
+    # Types the encoders do not handle natively
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    if isinstance(value, uuid.UUID):
+        return str(value)
+
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+
+    raise TypeError('Object of type {} is not JSON serializable'.format(
+        type(value).__name__))
+
+
+class StdlibJSONProvider:
+    name = 'stdlib'
+
+    def dumps(self, value):
+        return json.dumps(value, default=default, separators=(',', ':'))
+
+    def dumps_bytes(self, value):
+        return self.dumps(value).encode()
+
+
+class OrjsonJSONProvider:
+    name = 'orjson'
+
+    def dumps(self, value):
+        return self.dumps_bytes(value).decode()
+
+    def dumps_bytes(self, value):
+        # orjson writes datetimes as ISO-8601 itself, like default() does
+        return orjson.dumps(value, default=default,
+                            option=orjson.OPT_NON_STR_KEYS)
+
+
+PROVIDERS = {'stdlib': StdlibJSONProvider, 'orjson': OrjsonJSONProvider}
+
+
+def get_provider(name=JSON_PROVIDER):
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+
+    if name not in PROVIDERS or name == 'orjson' and orjson is None:
+        raise ValueError('Unknown or unavailable JSON provider: ' + name)
+
+    return PROVIDERS[name]()
+
+
+class ISOJSONEncoder(JSONEncoder):
+    # Keeps flask.json.dumps consistent with the providers
+
+    def default(self, value):
+        try:
+            return default(value)
+
+        except TypeError:
+            return JSONEncoder.default(self, value)
+
+
+def init_json(app, provider=None):
+    app.extensions['json_provider'] = provider or get_provider()
+    app.json_encoder = ISOJSONEncoder
+
+
+def dumps(value):
+    return current_app.extensions['json_provider'].dumps(value)
+
+
+def dumps_bytes(value):
+    return current_app.extensions['json_provider'].dumps_bytes(value)
+
+
+def jsonify(*args, **kwargs):
+    '''
+    jsonify(*args, **kwargs)
+        same arguments as flask.jsonify; returns a JSON response encoded by
+        the app's provider
+    '''
+    if args and kwargs:
+        raise TypeError('jsonify() takes either args or kwargs, not both')
+
+    data = args[0] if len(args) == 1 else (args or kwargs)
+
+    return current_app.response_class(
+        current_app.extensions['json_provider'].dumps_bytes(data) + b'\n',
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def jsonify_fragments(key, fragments, **envelope):
+    '''
+    jsonify_fragments(key, fragments, **envelope)
+        returns a JSON response of envelope with a list under key made of
+        already encoded items, which are copied in without re-encoding
+    '''
+    provider = current_app.extensions['json_provider']
+    head = provider.dumps_bytes(envelope)[:-1] + (b',' if envelope else b'')
+
+    return current_app.response_class(
+        head + provider.dumps_bytes(key) + b':[' + b','.join(fragments) +
+        b']}\n', mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,322 @@
+'''
+Hash sharding of actors and movies across several databases.
+
+Each actor and movie row lives on the shard its id hashes to, and a movie's
+cast links live on the movie's shard. Ids are allocated globally in blocks
+reserved on the primary, so a row's shard is known before it is written
+and ids chosen by clients never collide across shards. Change tracking,
+tombstones and the change feed outbox stay on the primary.
+
+Queries on sharded tables run against the shard selected with
+ShardSet.using(); list queries run once per shard and the pages are merged
+in sort key order, so cursors work exactly as they do on one database.
+
+Writes commit the shard and the primary in one session but not atomically;
+there is no two-phase commit across SQLite files.
+'''
+import os
+import heapq
+import threading
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cmp_to_key
+
+from sqlalchemy import MetaData, Table, Column, Integer, ForeignKey, Index, \
+    select
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Actor, Movie, movie_actors, make_engine, \
+    get_shard_set, reserve_ids, skip_ids, DB_PROFILE, DB_CREATE_ALL
+
+DATABASE_SHARD_URLS = [url.strip() for url in os.getenv(
+    'DATABASE_SHARD_URLS', '').split(',') if url.strip()]
+ID_BLOCK_SIZE = int(os.getenv('ID_BLOCK_SIZE', 100))
+
+SHARDED_TABLES = frozenset(['actors', 'movies', 'movie_actors'])
+
+current_shard = ContextVar('current_shard', default=None)
+
+# Shards keep cast links with the movie; the actor may be on another shard
+shard_metadata = MetaData()
+shard_movie_actors = Table(
+    'movie_actors', shard_metadata,
+    Column('movie_id', Integer,
+           ForeignKey(Movie.id, ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer, primary_key=True),
+    Index('ix_movie_actors_actor_id', 'actor_id', 'movie_id')
+)
+
+
+def shard_index(row_id, count):
+    # Stable across processes, unlike hash() of a str
+    return zlib.crc32(row_id.to_bytes(8, 'big', signed=True)) % count
+
+
+class IdAllocator:
+    # Hands out ids from blocks reserved on the primary
+
+    def __init__(self, block_size=ID_BLOCK_SIZE, reserve=reserve_ids,
+                 skip=skip_ids):
+        self.block_size = block_size
+        self.reserve = reserve
+        self.skip_ids = skip
+
+        self.reservations = 0
+
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, name, count):
+        ids = []
+
+        with self._lock:
+            while len(ids) < count:
+                next_id, end = self._blocks.get(name, (0, 0))
+
+                if next_id >= end:
+                    size = max(self.block_size, count - len(ids))
+                    next_id = self.reserve(name, size)
+                    end = next_id + size
+                    self.reservations += 1
+
+                taken = min(end - next_id, count - len(ids))
+                ids.extend(range(next_id, next_id + taken))
+                self._blocks[name] = (next_id + taken, end)
+
+        return ids
+
+    def skip(self, name, row_id):
+        # A block holding the id is dropped; the sequence moves past it
+        with self._lock:
+            next_id, end = self._blocks.get(name, (0, 0))
+
+            if next_id <= row_id < end:
+                del self._blocks[name]
+
+        self.skip_ids(name, row_id)
+
+
+class ShardSet:
+
+    def __init__(self, engines, allocator=None, tables=SHARDED_TABLES):
+        self.engines = engines
+        self.allocator = allocator or IdAllocator()
+        self.tables = tables
+
+    def for_id(self, row_id):
+        return self.engines[shard_index(row_id, len(self.engines))]
+
+    def current(self):
+        engine = current_shard.get()
+
+        if engine is None:
+            raise RuntimeError('No shard selected for a sharded table.')
+
+        return engine
+
+    @contextmanager
+    def using(self, engine):
+        token = current_shard.set(engine)
+
+        try:
+            yield engine
+
+        finally:
+            current_shard.reset(token)
+
+    def group(self, items, id_of=lambda item: item):
+        '''
+        group(items, id_of)
+            returns (engine, items) pairs for every shard holding at least
+            one of items, in shard order
+        '''
+        groups = {}
+        for item in items:
+            groups.setdefault(self.for_id(id_of(item)), []).append(item)
+
+        return [(engine, groups[engine]) for engine in self.engines
+                if engine in groups]
+
+    def allocate(self, name, count):
+        return self.allocator.allocate(name, count)
+
+    def skip(self, name, row_id):
+        self.allocator.skip(name, row_id)
+
+    def stats(self):
+        return {
+            'shards': len(self.engines),
+            'id_reservations': self.allocator.reservations
+        }
+
+
+@contextmanager
+def shard_for(row_id):
+    # Runs the block on the shard holding row_id; a no-op without shards
+    shards = get_shard_set()
+
+    if shards is None:
+        yield None
+        return
+
+    with shards.using(shards.for_id(row_id)) as engine:
+        yield engine
+
+
+def each_shard(call):
+    '''
+    each_shard(call)
+        returns the results of call() run once on every shard, or a one
+        item list of call() without shards
+    '''
+    shards = get_shard_set()
+
+    if shards is None:
+        return [call()]
+
+    results = []
+    for engine in shards.engines:
+        with shards.using(engine):
+            results.append(call())
+
+    return results
+
+
+def each_shard_iter(call):
+    '''
+    each_shard_iter(call)
+        returns one iterator per shard over the rows call() reads there;
+        every step runs on its shard, so chunked fetches and eager loads
+        made while iterating find it too
+    '''
+    shards = get_shard_set()
+
+    if shards is None:
+        return [call()]
+
+    def read(engine):
+        with shards.using(engine):
+            rows = iter(call())
+
+        while True:
+            with shards.using(engine):
+                row = next(rows, rows)
+
+            if row is rows:
+                return
+
+            yield row
+
+    return [read(engine) for engine in shards.engines]
+
+
+def each_group(ids, call):
+    # call(ids) once per shard with the ids that shard holds
+    shards = get_shard_set()
+
+    if shards is None:
+        return [call(list(ids))] if ids else []
+
+    results = []
+    for engine, group in shards.group(ids):
+        with shards.using(engine):
+            results.append(call(group))
+
+    return results
+
+
+def merge(results, key):
+    # Merge per-shard results already sorted by key
+    if len(results) == 1:
+        return results[0]
+
+    return heapq.merge(*results, key=key)
+
+
+def fan_out(call, key):
+    '''
+    fan_out(call, key)
+        returns the rows call() reads from every shard as one list sorted
+        by key; every shard must return its rows sorted by key too
+    '''
+    return list(merge(each_shard(call), key))
+
+
+def sort_key(keys):
+    '''
+    sort_key(keys)
+        returns a key function ordering rows like ORDER BY on the
+        (name, descending) pairs of keys, with NULLs first like SQLite
+    '''
+    def compare(left, right):
+        for name, descending in keys:
+            first, second = getattr(left, name), getattr(right, name)
+
+            if first == second:
+                continue
+
+            less = first is None or (second is not None and first < second)
+            return (1 if less else -1) if descending else (-1 if less else 1)
+
+        return 0
+
+    return cmp_to_key(compare)
+
+
+def load_casts(movies):
+    '''
+    load_casts(movies)
+        sets the actors of every movie from their own shards, replacing
+        the eager load that only sees actors on the movie's shard
+    '''
+    shards = get_shard_set()
+
+    if shards is None or not movies:
+        return movies
+
+    links = {}
+    for engine, group in shards.group(movies, lambda movie: movie.id):
+        with shards.using(engine):
+            for movie_id, actor_id in db.session.execute(
+                    select([movie_actors.c.movie_id, movie_actors.c.actor_id])
+                    .where(movie_actors.c.movie_id.in_(
+                        [movie.id for movie in group]))):
+                links.setdefault(movie_id, []).append(actor_id)
+
+    actors = {}
+    for group in each_group({actor_id for actor_ids in links.values()
+                             for actor_id in actor_ids},
+                            lambda ids: Actor.query.filter(
+                                Actor.id.in_(ids)).all()):
+        actors.update((actor.id, actor) for actor in group)
+
+    for movie in movies:
+        set_committed_value(movie, 'actors', [
+            actors[actor_id] for actor_id in sorted(links.get(movie.id, []))
+            if actor_id in actors])
+
+    return movies
+
+
+def create_shard_schema(engine):
+    # Search indexes come with the tables, as they do on the primary
+    db.metadata.create_all(engine, tables=[Actor.__table__, Movie.__table__])
+    shard_metadata.create_all(engine)
+
+
+def init_shards(app):
+    urls = app.config.get('SQLALCHEMY_SHARD_URIS', DATABASE_SHARD_URLS)
+
+    if not urls:
+        return
+
+    profile = app.config.get('DB_PROFILE', DB_PROFILE)
+    shards = ShardSet(
+        [make_engine(url, profile) for url in urls],
+        IdAllocator(app.config.get('ID_BLOCK_SIZE', ID_BLOCK_SIZE)))
+    app.extensions['shards'] = shards
+
+    if app.config.get('DB_CREATE_ALL', DB_CREATE_ALL):
+        for engine in shards.engines:
+            create_shard_schema(engine)
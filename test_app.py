@@ -1,10 +1,30 @@
 import os
+import sys
+import time
+import datetime
+import tempfile
 import unittest
+import unittest.mock
 import json
+import runpy
+import threading
+import sqlite3
+import subprocess
+from contextlib import contextmanager
+import rsa
+import sqlalchemy
 from flask_sqlalchemy import SQLAlchemy
-
+from jose import jwk, jwt
+
+import auth
+import app as app_module
+import models
+import serialization
+import replicas
+import sharding
 from app import create_app
-from models import setup_db, Actor, Movie, database_path
+from models import setup_db, db, Actor, Movie, database_path
+from auth import AuthError, JWKSCache, TokenCache, parse_max_age
 
 # Test auth headers
 
@@ -20,6 +40,25 @@ producer_auth_header = {
     'Authorization': 'Bearer ' + os.getenv('PRODUCER_AUTH_TOKEN')
 }
 
+# Local signing key for tests that must not depend on Auth0
+test_public_key, test_private_key = rsa.newkeys(2048)
+test_key_pem = test_private_key.save_pkcs1().decode()
+test_jwks = {'keys': [dict(
+    jwk.construct(test_public_key.save_pkcs1().decode(), 'RS256').to_dict(),
+    kid='test-key', use='sig')]}
+
+
+def make_token(permissions, kid='test-key', expires_in=3600):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://' + str(auth.AUTH0_DOMAIN) + '/',
+        'aud': auth.API_AUDIENCE,
+        'sub': 'auth0|test',
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions
+    }, test_key_pem, algorithm='RS256', headers={'kid': kid})
+
 
 class CastingAgencyTestCase(unittest.TestCase):
 
@@ -278,5 +317,1723 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
 
 
+class JWKSCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fetches = 0
+
+    def fetcher(self, url):
+        self.fetches += 1
+        return test_jwks, None
+
+    def test_cache_hit_does_not_fetch(self):
+        cache = JWKSCache('jwks-url', fetcher=self.fetcher)
+        cache.load(test_jwks)
+
+        for _ in range(5):
+            self.assertEqual(cache.get_key('test-key')['kid'], 'test-key')
+
+        self.assertEqual(self.fetches, 0)
+        self.assertEqual(cache.stats()['hits'], 5)
+
+    def test_unknown_kid_refreshes_once(self):
+        cache = JWKSCache('jwks-url', fetcher=self.fetcher)
+
+        self.assertIsNotNone(cache.get_key('test-key'))
+        self.assertIsNone(cache.get_key('rotated-key'))
+        self.assertIsNone(cache.get_key('rotated-key'))
+
+        # The second unknown kid lands inside the refresh cooldown
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    def test_concurrent_misses_single_flight(self):
+        gate = threading.Event()
+
+        def slow_fetcher(url):
+            gate.wait()
+            return self.fetcher(url)
+
+        cache = JWKSCache('jwks-url', cooldown=0, fetcher=slow_fetcher)
+        threads = [threading.Thread(target=cache.get_key, args=('test-key',))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetches, 1)
+
+    def test_fetch_runs_outside_lock(self):
+        cache = JWKSCache('jwks-url', fetcher=None)
+        held = []
+
+        def fetcher(url):
+            # Waiting callers must be able to take the lock meanwhile
+            held.append(not cache._lock.acquire(blocking=False))
+            if not held[-1]:
+                cache._lock.release()
+            return self.fetcher(url)
+
+        cache.fetcher = fetcher
+        cache.refresh()
+
+        self.assertEqual(held, [False])
+        self.assertIsNotNone(cache.get_key('test-key'))
+
+    def test_expired_cache_refreshes(self):
+        cache = JWKSCache('jwks-url', ttl=0, cooldown=0,
+                          fetcher=self.fetcher)
+        cache.load(test_jwks)
+        cache.get_key('test-key')
+
+        self.assertEqual(self.fetches, 1)
+
+    def test_fetch_error_keeps_stale_keys(self):
+        def failing_fetcher(url):
+            raise OSError('provider down')
+
+        cache = JWKSCache('jwks-url', ttl=0, cooldown=0,
+                          fetcher=failing_fetcher)
+        cache.load(test_jwks)
+
+        self.assertIsNotNone(cache.get_key('test-key'))
+        self.assertEqual(cache.stats()['refresh_errors'], 1)
+
+    def test_parse_max_age(self):
+        self.assertEqual(parse_max_age('public, max-age=120'), 120)
+        self.assertEqual(parse_max_age('no-store'), 0)
+        self.assertIsNone(parse_max_age(None))
+
+    def test_verify_decode_jwt_uses_cache(self):
+        auth.jwks_cache.load(test_jwks)
+        misses = auth.jwks_cache.misses
+
+        payload = auth.verify_decode_jwt(make_token(['get:actors']))
+
+        self.assertEqual(payload['permissions'], ['get:actors'])
+        self.assertEqual(auth.jwks_cache.misses, misses)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        auth.jwks_cache.load(test_jwks)
+        auth.token_cache.clear()
+
+    def test_repeated_token_skips_verification(self):
+        token = make_token(['get:actors'])
+        hits = auth.token_cache.hits
+
+        auth.verify_token(token)
+        payload, permissions = auth.verify_token(token)
+
+        self.assertEqual(auth.token_cache.hits, hits + 1)
+        self.assertEqual(permissions, frozenset(['get:actors']))
+        self.assertTrue(auth.check_permissions('get:actors', payload,
+                                               permissions))
+
+    def test_token_inside_leeway_not_cached(self):
+        cache = TokenCache(leeway=30)
+        token = make_token(['get:actors'], expires_in=10)
+        payload = jwt.get_unverified_claims(token)
+
+        cache.put(token, payload, frozenset(payload['permissions']))
+
+        self.assertIsNone(cache.get(token))
+
+    def test_lru_bound(self):
+        cache = TokenCache(maxsize=2)
+        payload = {'exp': int(time.time()) + 3600}
+
+        for token in ('a', 'b', 'c'):
+            cache.put(token, payload, frozenset())
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_disabled_cache(self):
+        cache = TokenCache(enabled=False)
+        cache.put('a', {'exp': int(time.time()) + 3600}, frozenset())
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_missing_permission(self):
+        with self.assertRaises(AuthError):
+            auth.check_permissions('post:movies', {},
+                                   frozenset(['get:movies']))
+
+
+class LocalAppTestCase(unittest.TestCase):
+    # Runs the app against a throwaway SQLite file and locally signed tokens
+
+    def setUp(self):
+        auth.jwks_cache.load(test_jwks)
+        db_fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_file,
+            'DB_CREATE_ALL': True
+        })
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer ' + make_token([
+            'get:actors', 'get:movies', 'post:actors', 'post:movies',
+            'patch:actors', 'patch:movies', 'delete:actors',
+            'delete:movies'])}
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        os.remove(self.db_file)
+
+    @contextmanager
+    def record_statements(self, on_statement=None):
+        # Yields the SQL of every statement the app runs inside the block
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+            if on_statement is not None:
+                on_statement(statement)
+
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', record)
+
+    def add_actors(self, count):
+        for number in range(count):
+            self.client().post('/actors', headers=self.headers, json={
+                'name': 'Actor {}'.format(number), 'age': 30 + number,
+                'gender': 'Female'})
+
+    def add_movies(self, count):
+        for number in range(count):
+            self.client().post('/movies', headers=self.headers, json={
+                'title': 'Movie {}'.format(number),
+                'release_date': '2000-01-{:02d}'.format(number % 28 + 1)})
+
+
+class PaginationTestCase(LocalAppTestCase):
+
+    def test_cursor_pages_cover_table(self):
+        self.add_actors(5)
+        seen = []
+        cursor = None
+
+        while True:
+            query = '/actors?limit=2' + ('&cursor=' + cursor if cursor else '')
+            data = json.loads(self.client().get(query,
+                                                headers=self.headers).data)
+            seen += [actor['id'] for actor in data['actors']]
+            self.assertEqual(data['actor_count'], 5)
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), 5)
+
+    def test_unpaginated_mode_is_capped(self):
+        self.add_movies(3)
+
+        with unittest.mock.patch('app.UNPAGINATED_ROW_CAP', 2):
+            res = self.client().get('/movies', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['movies']), 2)
+        self.assertEqual(data['movie_count'], 3)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_invalid_page_args_400(self):
+        for query in ('/actors?limit=0', '/actors?limit=x',
+                      '/actors?cursor=not-a-cursor'):
+            res = self.client().get(query, headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+
+class StreamingTestCase(LocalAppTestCase):
+
+    def test_stream_query_param(self):
+        self.add_movies(3)
+
+        with unittest.mock.patch('app.STREAM_CHUNK_SIZE', 2):
+            res = self.client().get('/movies?stream=1', headers=self.headers)
+            lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['title'] for line in lines],
+                         ['Movie 0', 'Movie 1', 'Movie 2'])
+
+    def test_stream_accept_header(self):
+        self.add_actors(2)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+
+        res = self.client().get('/actors', headers=headers)
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(res.data.decode().splitlines()), 2)
+
+    def test_default_is_json(self):
+        res = self.client().get('/actors', headers=self.headers)
+
+        self.assertEqual(res.mimetype, 'application/json')
+
+
+class CastTestCase(LocalAppTestCase):
+
+    def test_patch_cast_keeps_api_shape(self):
+        self.add_actors(3)
+        self.add_movies(1)
+
+        res = self.client().patch('/movies/1', json={'cast': [3, 1]},
+                                  headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie_cast'], '1,3')
+
+        with self.app.app_context():
+            self.assertEqual([movie.id for movie in Actor.query.get(3).movies],
+                             [1])
+
+    def test_patch_cast_unknown_actor_422(self):
+        self.add_movies(1)
+
+        res = self.client().patch('/movies/1', json={'cast': [42]},
+                                  headers=self.headers)
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_delete_actor_removes_cast_links(self):
+        self.add_actors(2)
+        self.add_movies(1)
+        self.client().patch('/movies/1', json={'cast': [1, 2]},
+                            headers=self.headers)
+
+        self.client().delete('/actors/2', headers=self.headers)
+        data = json.loads(self.client().get('/movies',
+                                            headers=self.headers).data)
+
+        self.assertEqual(data['movies'][0]['cast'], '1')
+
+
+class FilmographyTestCase(LocalAppTestCase):
+
+    def test_actor_movies_sorted_and_paginated(self):
+        self.add_actors(2)
+        for title, release_date in (('Late', '2010-05-01'),
+                                    ('Early', '1990-05-01'),
+                                    ('Middle', '2000-05-01'),
+                                    ('Other', '1980-05-01')):
+            self.client().post('/movies', headers=self.headers, json={
+                'title': title, 'release_date': release_date})
+        for movie_id in (1, 2, 3):
+            self.client().patch('/movies/{}'.format(movie_id),
+                                json={'cast': [1]}, headers=self.headers)
+
+        titles = []
+        cursor = None
+        while True:
+            query = '/actors/1/movies?limit=2'
+            if cursor:
+                query += '&cursor=' + cursor
+            data = json.loads(self.client().get(query,
+                                                headers=self.headers).data)
+            titles += [movie['title'] for movie in data['movies']]
+            self.assertEqual(data['movie_count'], 3)
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(titles, ['Early', 'Middle', 'Late'])
+
+    def test_actor_movies_404(self):
+        res = self.client().get('/actors/99/movies', headers=self.headers)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_actor_movies_uses_index(self):
+        with self.app.app_context():
+            plan = db.session.execute(
+                'EXPLAIN QUERY PLAN SELECT movie_id FROM movie_actors '
+                'WHERE actor_id = 1').fetchall()
+
+        self.assertIn('ix_movie_actors_actor_id', str(plan))
+
+
+class ExpandCastTestCase(LocalAppTestCase):
+
+    def get_movies_query_count(self, path):
+        with self.record_statements() as statements:
+            res = self.client().get(path, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return len([statement for statement in statements
+                    if statement.startswith('SELECT')])
+
+    def test_expand_cast_embeds_actors(self):
+        self.add_actors(2)
+        self.add_movies(1)
+        self.client().patch('/movies/1', json={'cast': [2, 1]},
+                            headers=self.headers)
+
+        for path in ('/movies?expand=cast', '/movies/1?expand=cast'):
+            data = json.loads(self.client().get(path,
+                                                headers=self.headers).data)
+            movie = data['movies'][0] if 'movies' in data else data['movie']
+            self.assertEqual([actor['name'] for actor in movie['cast']],
+                             ['Actor 0', 'Actor 1'])
+
+    def test_expand_cast_query_count_is_constant(self):
+        self.add_actors(4)
+        self.add_movies(2)
+        for movie_id in (1, 2):
+            self.client().patch('/movies/{}'.format(movie_id),
+                                json={'cast': [1, 2]}, headers=self.headers)
+        small_page = self.get_movies_query_count('/movies?expand=cast')
+
+        self.add_movies(6)
+        for movie_id in range(3, 9):
+            self.client().patch('/movies/{}'.format(movie_id),
+                                json={'cast': [movie_id % 4 + 1]},
+                                headers=self.headers)
+        large_page = self.get_movies_query_count('/movies?expand=cast')
+
+        self.assertEqual(small_page, large_page)
+
+    def test_unknown_expand_400(self):
+        res = self.client().get('/movies?expand=crew', headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movie_404(self):
+        res = self.client().get('/movies/99', headers=self.headers)
+
+        self.assertEqual(res.status_code, 404)
+
+
+class BulkCreateTestCase(LocalAppTestCase):
+
+    def test_bulk_actors_partial_success(self):
+        res = self.client().post('/actors/bulk', headers=self.headers, json=[
+            {'name': 'Meryl Streep', 'age': 71, 'gender': 'Female'},
+            {'name': 'No Age', 'gender': 'Male'},
+            {'name': 'Tom Hanks', 'age': '64', 'gender': 'Male'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([result['success'] for result in data['results']],
+                         [True, False, True])
+        self.assertEqual(data['results'][1]['error'], 400)
+
+        with self.app.app_context():
+            self.assertEqual(Actor.query.get(
+                data['results'][2]['actor_id']).name, 'Tom Hanks')
+
+    def test_bulk_movies_in_chunks(self):
+        movies = [{'title': 'Movie {}'.format(number),
+                   'release_date': '2001-02-03'} for number in range(5)]
+
+        with unittest.mock.patch('app.BULK_CHUNK_SIZE', 2):
+            res = self.client().post('/movies/bulk', headers=self.headers,
+                                     json=movies)
+        data = json.loads(res.data)
+
+        self.assertTrue(data['success'])
+        self.assertEqual(len({result['movie_id']
+                              for result in data['results']}), 5)
+
+    def test_bulk_chunk_is_one_insert(self):
+        self.add_actors(2)
+        actors = [{'name': 'Bulk {}'.format(number), 'age': 40,
+                   'gender': 'Male'} for number in range(5)]
+
+        with self.record_statements() as statements:
+            res = self.client().post('/actors/bulk', headers=self.headers,
+                                     json=actors)
+        ids = [result['actor_id']
+               for result in json.loads(res.data)['results']]
+
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('INSERT INTO actors')]),
+                         1)
+        self.assertEqual(ids, [3, 4, 5, 6, 7])
+        with self.app.app_context():
+            self.assertEqual([Actor.query.get(actor_id).name
+                              for actor_id in ids],
+                             [actor['name'] for actor in actors])
+
+    def test_bulk_requires_list(self):
+        res = self.client().post('/actors/bulk', headers=self.headers,
+                                 json={'name': 'Meryl Streep'})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_bulk_keeps_permissions(self):
+        headers = {'Authorization': 'Bearer ' + make_token(['post:actors'])}
+        res = self.client().post('/movies/bulk', headers=headers, json=[
+            {'title': 'Movie', 'release_date': '2001-02-03'}])
+
+        self.assertEqual(res.status_code, 401)
+
+
+class WritePathTestCase(LocalAppTestCase):
+
+    def test_patch_actor_single_statement(self):
+        self.add_actors(1)
+
+        with self.record_statements() as statements:
+            res = self.client().patch('/actors/1', json={'age': '93'},
+                                      headers=self.headers)
+        data = json.loads(res.data)
+
+        # The other statements are the change-version bump and the outbox
+        statements = [statement for statement in statements
+                      if 'table_versions' not in statement and
+                      'change_events' not in statement]
+        self.assertEqual(data['actor_age'], 93)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('UPDATE'))
+
+    def test_patch_without_returning(self):
+        self.add_movies(1)
+
+        with unittest.mock.patch('models.supports_returning',
+                                 return_value=False):
+            res = self.client().patch('/movies/1', headers=self.headers,
+                                      json={'title': 'Renamed'})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['movie_title'], 'Renamed')
+        self.assertIsNone(data['movie_cast'])
+
+    def test_patch_unknown_attribute_400(self):
+        self.add_actors(1)
+
+        for body in ({'id': 5}, {'salary': 10}, {'age': 'old'}):
+            res = self.client().patch('/actors/1', json=body,
+                                      headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_missing_rows_404(self):
+        requests = (
+            self.client().patch('/actors/9', json={'age': 40},
+                                headers=self.headers),
+            self.client().patch('/movies/9', json={'cast': []},
+                                headers=self.headers),
+            self.client().delete('/actors/9', headers=self.headers),
+            self.client().delete('/movies/9', headers=self.headers))
+
+        for res in requests:
+            self.assertEqual(res.status_code, 404)
+
+    def test_delete_movie_removes_cast_links(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        self.client().patch('/movies/1', json={'cast': [1]},
+                            headers=self.headers)
+
+        res = self.client().delete('/movies/1', headers=self.headers)
+        data = json.loads(self.client().get('/actors/1/movies',
+                                            headers=self.headers).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie_count'], 0)
+
+
+class UpsertTestCase(LocalAppTestCase):
+
+    def test_post_existing_id_reports_existing_row(self):
+        movie = {'title': 'Bicentennial man', 'release_date': '1999-12-13'}
+        first = json.loads(self.client().post(
+            '/movies/7', json=movie, headers=self.headers).data)
+        second = json.loads(self.client().post(
+            '/movies/7', json=dict(movie, title='Other'),
+            headers=self.headers).data)
+
+        self.assertTrue(first['success'])
+        self.assertFalse(second['success'])
+        self.assertEqual(second['movie_title'], 'Bicentennial man')
+
+    def test_post_invalid_body_matches_collection(self):
+        for path, body in (('/actors', {'name': 'No Age'}),
+                           ('/actors/3', {'name': 'No Age'}),
+                           ('/movies', {'title': 'No Date'}),
+                           ('/movies/3', {'title': 'No Date'})):
+            res = self.client().post(path, json=body, headers=self.headers)
+            self.assertEqual(res.status_code, 422, path)
+
+    def test_concurrent_writers_same_id(self):
+        results = []
+        barrier = threading.Barrier(16)
+
+        def writer(number):
+            client = self.app.test_client()
+            barrier.wait()
+            res = client.post('/actors/5', headers=self.headers, json={
+                'name': 'Writer {}'.format(number), 'age': 40,
+                'gender': 'Female'})
+            results.append((res.status_code, json.loads(res.data)))
+
+        threads = [threading.Thread(target=writer, args=(number,))
+                   for number in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual({status for status, data in results}, {200})
+        winners = [data for status, data in results if data['success']]
+        self.assertEqual(len(winners), 1)
+        self.assertTrue(all(data['actor_name'] == winners[0]['actor_name']
+                            for status, data in results))
+
+
+class FilterSortTestCase(LocalAppTestCase):
+
+    def add_cast(self):
+        for name, age, gender in (('Ann', 30, 'Female'), ('Bob', 45, 'Male'),
+                                  ('Cat', 33, 'Female'), ('Dan', 30, 'Male'),
+                                  ('Eve', 30, 'Female'), ('Fay', 52, 'Female')):
+            self.client().post('/actors', headers=self.headers, json={
+                'name': name, 'age': age, 'gender': gender})
+
+    def get_all_pages(self, query):
+        names = []
+        cursor = None
+        while True:
+            path = query + ('&cursor=' + cursor if cursor else '')
+            data = json.loads(self.client().get(path,
+                                                headers=self.headers).data)
+            names += [actor['name'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                return names, data['actor_count']
+
+    def explain(self, model, query_string):
+        with self.app.test_request_context('/?' + query_string):
+            filters = app_module.get_filter_args(model, {
+                Actor: app_module.ACTOR_FIELDS,
+                Movie: app_module.MOVIE_FIELDS}[model])
+            keys = app_module.get_sort_args({
+                Actor: app_module.ACTOR_FIELDS,
+                Movie: app_module.MOVIE_FIELDS}[model])
+            query = app_module.build_list_query(model, filters, keys)
+            compiled = query.statement.compile(dialect=db.engine.dialect)
+            params = [compiled.params[name] for name in compiled.positiontup]
+            connection = db.engine.raw_connection()
+            try:
+                return str(connection.execute(
+                    'EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall())
+            finally:
+                connection.close()
+
+    def test_equality_and_range_filters(self):
+        self.add_cast()
+
+        names, count = self.get_all_pages(
+            '/actors?limit=2&gender=Female&age_min=30&age_max=40')
+
+        self.assertEqual(names, ['Ann', 'Cat', 'Eve'])
+        self.assertEqual(count, 3)
+
+    def test_multi_key_sort_with_cursor(self):
+        self.add_cast()
+
+        names, count = self.get_all_pages('/actors?limit=2&sort=-age,name')
+
+        self.assertEqual(names, ['Fay', 'Bob', 'Cat', 'Ann', 'Dan', 'Eve'])
+
+    def test_movie_release_window(self):
+        self.add_movies(10)
+
+        data = json.loads(self.client().get(
+            '/movies?release_date_min=2000-01-03&release_date_max=2000-01-05'
+            '&sort=-release_date', headers=self.headers).data)
+
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['Movie 4', 'Movie 3', 'Movie 2'])
+
+    def test_invalid_filter_and_sort_400(self):
+        for query in ('/actors?sort=salary', '/actors?age_min=old',
+                      '/actors?sort=age,age'):
+            res = self.client().get(query, headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_cursor_bound_to_sort(self):
+        self.add_cast()
+        data = json.loads(self.client().get(
+            '/actors?limit=2&sort=age', headers=self.headers).data)
+
+        res = self.client().get('/actors?limit=2&sort=name&cursor=' +
+                                data['next_cursor'], headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_filtered_queries_use_indexes(self):
+        checks = (
+            (Actor, 'gender=Female&age_min=30&age_max=40',
+             'ix_actors_gender_age'),
+            (Actor, 'age_min=30&sort=age', 'ix_actors_age'),
+            (Actor, 'name=Ann', 'ix_actors_name'),
+            (Movie, 'release_date_min=2000-01-01&release_date_max=2000-02-01'
+             '&sort=release_date', 'ix_movies_release_date_id'),
+            (Movie, 'title=Movie', 'ix_movies_title'))
+
+        for model, query_string, index in checks:
+            plan = self.explain(model, query_string)
+            self.assertIn(index, plan, query_string)
+
+
+class SearchTestCase(LocalAppTestCase):
+
+    def test_prefix_search_ranked(self):
+        for name in ('Robin Williams', 'Robert Downey', 'Will Smith',
+                     'Robin Wright'):
+            self.client().post('/actors', headers=self.headers, json={
+                'name': name, 'age': 50, 'gender': 'Male'})
+
+        data = json.loads(self.client().get(
+            '/actors/search?q=rob wil', headers=self.headers).data)
+
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Robin Williams'])
+
+    def test_search_follows_writes(self):
+        self.add_movies(1)
+        self.client().patch('/movies/1', json={'title': 'Jumanji'},
+                            headers=self.headers)
+
+        found = json.loads(self.client().get(
+            '/movies/search?q=juma', headers=self.headers).data)
+        self.client().delete('/movies/1', headers=self.headers)
+        gone = json.loads(self.client().get(
+            '/movies/search?q=juma', headers=self.headers).data)
+
+        self.assertEqual(len(found['movies']), 1)
+        self.assertEqual(gone['movies'], [])
+
+    def test_search_pages(self):
+        self.add_actors(5)
+        names = []
+        cursor = None
+        while True:
+            path = '/actors/search?q=actor&limit=2'
+            if cursor:
+                path += '&cursor=' + cursor
+            data = json.loads(self.client().get(path,
+                                                headers=self.headers).data)
+            names += [actor['name'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(sorted(names),
+                         ['Actor {}'.format(number) for number in range(5)])
+
+    def test_empty_query_400(self):
+        res = self.client().get('/actors/search?q=%20',
+                                headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+
+class ResponseCacheTestCase(LocalAppTestCase):
+
+    def get(self, path):
+        res = self.client().get(path, headers=self.headers)
+        return res, json.loads(res.data)
+
+    def test_repeat_read_hits(self):
+        self.add_actors(2)
+
+        first, data = self.get('/actors?sort=-age')
+        second, cached = self.get('/actors?sort=-age')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(cached, data)
+
+        stats = self.app.extensions['response_cache'].stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_writes_invalidate(self):
+        self.add_actors(1)
+        self.get('/actors')
+
+        self.client().post('/actors', headers=self.headers, json={
+            'name': 'New', 'age': 20, 'gender': 'Male'})
+        res, data = self.get('/actors')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['actor_count'], 2)
+
+        self.client().patch('/actors/2', json={'name': 'Renamed'},
+                            headers=self.headers)
+        res, data = self.get('/actors')
+        self.assertEqual(data['actors'][1]['name'], 'Renamed')
+
+        self.client().delete('/actors/2', headers=self.headers)
+        res, data = self.get('/actors')
+        self.assertEqual(data['actor_count'], 1)
+
+    def test_actor_delete_invalidates_movie_cast(self):
+        self.add_actors(2)
+        self.add_movies(1)
+        self.client().patch('/movies/1', json={'cast': [1, 2]},
+                            headers=self.headers)
+        res, before = self.get('/movies?expand=cast')
+
+        self.client().delete('/actors/2', headers=self.headers)
+        res, after = self.get('/movies?expand=cast')
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(before['movies'][0]['cast']), 2)
+        self.assertEqual([actor['id'] for actor in after['movies'][0]['cast']],
+                         [1])
+
+    def test_scope_and_stream_not_shared(self):
+        self.add_actors(1)
+        self.get('/actors')
+
+        other = self.client().get('/actors', headers={
+            'Authorization': 'Bearer ' + make_token(['get:actors'])})
+        streamed = self.client().get('/actors?stream=1', headers=self.headers)
+
+        self.assertEqual(other.headers['X-Cache'], 'MISS')
+        self.assertNotIn('X-Cache', streamed.headers)
+
+
+class ConditionalGetTestCase(LocalAppTestCase):
+
+    def get(self, path, **headers):
+        headers.update(self.headers)
+        return self.client().get(path, headers=headers)
+
+    def test_if_none_match_skips_query(self):
+        self.add_actors(2)
+        etag = self.get('/actors?sort=-age').headers['ETag']
+
+        with self.record_statements() as statements:
+            res = self.get('/actors?sort=-age', **{'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('table_versions', statements[0])
+
+    def test_etag_changes_after_write(self):
+        self.add_movies(1)
+        etag = self.get('/movies/1').headers['ETag']
+
+        self.client().patch('/movies/1', json={'title': 'Renamed'},
+                            headers=self.headers)
+        res = self.get('/movies/1', **{'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'Renamed')
+
+    def test_etag_depends_on_query(self):
+        self.add_actors(2)
+
+        first = self.get('/actors?limit=1').headers['ETag']
+        second = self.get('/actors?limit=2').headers['ETag']
+
+        self.assertNotEqual(first, second)
+
+    def test_if_modified_since(self):
+        self.add_actors(1)
+        res = self.get('/actors')
+        last_modified = res.headers['Last-Modified']
+
+        current = self.get('/actors', **{'If-Modified-Since': last_modified})
+        stale = self.get('/actors', **{
+            'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+
+        self.assertEqual(current.status_code, 304)
+        self.assertEqual(stale.status_code, 200)
+
+    def test_missing_row_patch_keeps_versions(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        etag = self.get('/movies').headers['ETag']
+
+        with self.app.app_context():
+            versions = models.get_versions('actors', 'movies')
+
+        for path, body in (('/actors/999', {'age': 50}),
+                           ('/movies/999', {'title': 'Gone'}),
+                           ('/movies/999', {'cast': [1]})):
+            res = self.client().patch(path, json=body, headers=self.headers)
+            self.assertEqual(res.status_code, 404)
+
+        with self.app.app_context():
+            self.assertEqual(models.get_versions('actors', 'movies'),
+                             versions)
+        self.assertEqual(self.get('/movies', **{
+            'If-None-Match': etag}).status_code, 304)
+
+    def test_not_found_has_no_etag(self):
+        res = self.get('/movies/42')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn('ETag', res.headers)
+
+
+class DeltaSyncTestCase(LocalAppTestCase):
+
+    def sync(self, path):
+        res = self.client().get(path, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_since_returns_changes_and_tombstones(self):
+        self.add_actors(3)
+        version = self.sync('/actors?since=0')['version']
+
+        self.client().patch('/actors/2', json={'age': 70},
+                            headers=self.headers)
+        self.client().delete('/actors/3', headers=self.headers)
+        data = self.sync('/actors?since={}'.format(version))
+
+        self.assertEqual([actor['id'] for actor in data['actors']], [2])
+        self.assertEqual(data['deleted'], [3])
+        self.assertGreater(data['version'], version)
+
+        again = self.sync('/actors?since={}'.format(data['version']))
+        self.assertEqual((again['actors'], again['deleted']), ([], []))
+
+    def test_since_pages_keep_high_water_mark(self):
+        self.add_actors(5)
+        first = self.sync('/actors?since=0&limit=2')
+        ids = [actor['id'] for actor in first['actors']]
+        cursor = first['next_cursor']
+
+        # A write between pages is picked up by the next sync instead
+        self.client().post('/actors', headers=self.headers, json={
+            'name': 'Late', 'age': 20, 'gender': 'Male'})
+
+        while cursor:
+            page = self.sync('/actors?since=0&limit=2&cursor=' + cursor)
+            self.assertEqual(page['version'], first['version'])
+            ids += [actor['id'] for actor in page['actors']]
+            cursor = page['next_cursor']
+
+        self.assertEqual(sorted(set(ids))[:5], [1, 2, 3, 4, 5])
+
+    def test_cast_changes_mark_movie(self):
+        self.add_actors(2)
+        self.add_movies(2)
+        self.client().patch('/movies/1', json={'cast': [1, 2]},
+                            headers=self.headers)
+        version = self.sync('/movies?since=0')['version']
+
+        self.client().delete('/actors/2', headers=self.headers)
+        data = self.sync('/movies?since={}'.format(version))
+
+        self.assertEqual([(movie['id'], movie['cast'])
+                          for movie in data['movies']], [(1, '1')])
+
+    def test_patch_with_cast_stamps_once(self):
+        self.add_actors(1)
+        self.add_movies(1)
+
+        with self.app.app_context():
+            version = models.get_versions('movies')['movies']
+
+        self.client().patch('/movies/1', json={'title': 'Renamed',
+                                               'cast': [1]},
+                            headers=self.headers)
+
+        with self.app.app_context():
+            self.assertEqual(models.get_versions('movies')['movies'],
+                             version + 1)
+            events = db.session.execute(
+                models.change_events.select()
+                .where(models.change_events.c.version > version)).fetchall()
+        self.assertEqual([(event.table_name, event.row_id)
+                          for event in events], [('movies', 1)])
+
+    def test_since_scans_index(self):
+        with self.app.app_context():
+            plan = ' '.join(str(row) for row in db.session.execute(
+                'EXPLAIN QUERY PLAN SELECT * FROM actors '
+                'WHERE row_version > 5 ORDER BY row_version, id'))
+
+        self.assertIn('ix_actors_row_version', plan)
+
+    def test_since_rejects_sort_and_bad_values(self):
+        for path in ('/actors?since=-1', '/actors?since=x',
+                     '/actors?since=0&sort=age', '/actors?since=0&age=30'):
+            res = self.client().get(path, headers=self.headers)
+            self.assertEqual(res.status_code, 400, path)
+
+
+class ChangeFeedTestCase(LocalAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.feed = self.app.extensions['change_feed']
+        self.feed.poll_interval = 0.01
+        self.feed.heartbeat = 0.05
+
+    def read_events(self, response, count):
+        # Read SSE messages until count change events arrived
+        events = []
+        chunks = iter(response.response)
+        deadline = time.time() + 5
+
+        while len(events) < count and time.time() < deadline:
+            for message in next(chunks).decode().split('\n\n'):
+                fields = dict(line.split(': ', 1)
+                              for line in message.splitlines()
+                              if line and not line.startswith(':'))
+                if fields.get('event') == 'change':
+                    events.append((int(fields['id']),
+                                   json.loads(fields['data'])))
+
+        return events
+
+    def test_streams_writes(self):
+        res = self.client().get('/events', headers=self.headers)
+        self.add_actors(1)
+        self.client().patch('/actors/1', json={'age': 50},
+                            headers=self.headers)
+        self.client().delete('/actors/1', headers=self.headers)
+
+        events = self.read_events(res, 3)
+        res.close()
+
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertEqual([(data['table'], data['action'], data['id'])
+                          for event_id, data in events],
+                         [('actors', 'create', 1), ('actors', 'update', 1),
+                          ('actors', 'delete', 1)])
+
+    def test_resume_from_last_event_id(self):
+        self.add_movies(3)
+
+        headers = dict(self.headers, **{'Last-Event-ID': '1'})
+        res = self.client().get('/events', headers=headers)
+        events = self.read_events(res, 2)
+        res.close()
+
+        self.assertEqual([event_id for event_id, data in events], [2, 3])
+
+    def test_actor_events_need_permission(self):
+        self.add_actors(1)
+        self.add_movies(1)
+
+        res = self.client().get('/events', headers={
+            'Authorization': 'Bearer ' + make_token(['get:movies']),
+            'Last-Event-ID': '0'})
+        events = self.read_events(res, 1)
+        res.close()
+
+        self.assertEqual([data['table'] for event_id, data in events],
+                         ['movies'])
+
+    def test_one_poll_query_for_all_subscribers(self):
+        with self.app.app_context():
+            subscribers = [self.feed.subscribe({'actors'})[0]
+                           for number in range(5)]
+
+        try:
+            with self.record_statements() as statements:
+                self.add_actors(2)
+                received = [subscriber.queue.get(timeout=5)
+                            for subscriber in subscribers]
+        finally:
+            for subscriber in subscribers:
+                self.feed.unsubscribe(subscriber)
+
+        # Each poll is one query, however many subscribers share it
+        polls = [statement for statement in statements
+                 if 'FROM change_events' in statement]
+        self.assertTrue(all(events == received[0] for events in received))
+        self.assertLessEqual(len(polls), self.feed.stats()['polls'])
+
+
+class JSONProviderTestCase(LocalAppTestCase):
+
+    def test_release_date_is_iso(self):
+        self.add_movies(1)
+
+        listed = json.loads(self.client().get(
+            '/movies', headers=self.headers).data)
+        streamed = json.loads(self.client().get(
+            '/movies?stream=1', headers=self.headers).data)
+
+        self.assertEqual(listed['movies'][0]['release date'],
+                         '2000-01-01T00:00:00')
+        self.assertEqual(streamed['release date'], '2000-01-01T00:00:00')
+
+    def test_providers_agree(self):
+        value = {'date': datetime.datetime(2000, 1, 2, 3, 4, 5, 6),
+                 'day': datetime.date(2000, 1, 2), 'list': [1, 'a', None]}
+        stdlib = serialization.get_provider('stdlib')
+
+        self.assertEqual(json.loads(stdlib.dumps(value)), {
+            'date': '2000-01-02T03:04:05.000006', 'day': '2000-01-02',
+            'list': [1, 'a', None]})
+
+        if serialization.orjson is not None:
+            self.assertEqual(serialization.get_provider('orjson').dumps(value),
+                             stdlib.dumps(value))
+
+    def test_falls_back_without_orjson(self):
+        with unittest.mock.patch('serialization.orjson', None):
+            self.assertEqual(serialization.get_provider('auto').name,
+                             'stdlib')
+            with self.assertRaises(ValueError):
+                serialization.get_provider('orjson')
+
+
+class SparseFieldsTestCase(LocalAppTestCase):
+
+    def get(self, path):
+        res = self.client().get(path, headers=self.headers)
+        return res.status_code, json.loads(res.data.splitlines()[0])
+
+    def test_only_requested_fields(self):
+        self.add_actors(2)
+        self.add_movies(1)
+
+        status, actors = self.get('/actors?fields=id,name')
+        status, movies = self.get('/movies?fields=title,release_date')
+
+        self.assertEqual(actors['actors'], [{'id': 1, 'name': 'Actor 0'},
+                                            {'id': 2, 'name': 'Actor 1'}])
+        self.assertEqual(movies['movies'], [{
+            'title': 'Movie 0', 'release date': '2000-01-01T00:00:00'}])
+
+    def test_pages_by_unselected_sort_key(self):
+        self.add_actors(3)
+        names = []
+        path = '/actors?fields=name&sort=-age&limit=2'
+
+        status, data = self.get(path)
+        names += [actor['name'] for actor in data['actors']]
+        status, data = self.get(path + '&cursor=' + data['next_cursor'])
+        names += [actor['name'] for actor in data['actors']]
+
+        self.assertEqual(names, ['Actor 2', 'Actor 1', 'Actor 0'])
+
+    def test_stream_and_since_use_fields(self):
+        self.add_actors(1)
+
+        status, streamed = self.get('/actors?fields=age&stream=1')
+        status, synced = self.get('/actors?fields=id&since=0')
+
+        self.assertEqual(streamed, {'age': 30})
+        self.assertEqual(synced['actors'], [{'id': 1}])
+
+    def test_rejects_unknown_fields(self):
+        for path in ('/actors?fields=id,salary', '/actors?fields=',
+                     '/actors?fields=id,id', '/movies?fields=cast',
+                     '/movies?fields=id&expand=cast'):
+            res = self.client().get(path, headers=self.headers)
+            self.assertEqual(res.status_code, 400, path)
+
+    def test_rows_skip_identity_map(self):
+        self.add_actors(3)
+
+        with self.app.app_context():
+            rows, cursor = app_module.get_page(
+                Actor, 10, selected=[Actor.id, Actor.name])
+
+            self.assertEqual([row.name for row in rows],
+                             ['Actor 0', 'Actor 1', 'Actor 2'])
+            self.assertEqual(len(db.session.identity_map), 0)
+
+
+class FragmentCacheTestCase(LocalAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app.extensions['response_cache'].enabled = False
+        self.fragments = self.app.extensions['fragment_cache']
+
+    def get(self, path):
+        return json.loads(self.client().get(path, headers=self.headers).data)
+
+    def test_pages_and_filters_share_fragments(self):
+        self.add_actors(4)
+
+        everything = self.get('/actors')
+        page = self.get('/actors?limit=2&sort=-age')
+        filtered = self.get('/actors?age_min=32')
+
+        self.assertEqual(self.fragments.stats()['misses'], 4)
+        self.assertEqual(self.fragments.stats()['hits'], 4)
+        self.assertEqual(page['actors'], everything['actors'][:1:-1])
+        self.assertEqual(filtered['actors'], everything['actors'][2:])
+        self.assertEqual(everything['actor_count'], 4)
+
+    def test_only_changed_rows_reencoded(self):
+        self.add_actors(3)
+        self.get('/actors')
+
+        self.client().patch('/actors/2', json={'name': 'Renamed'},
+                            headers=self.headers)
+        data = self.get('/actors')
+
+        self.assertEqual(data['actors'][1]['name'], 'Renamed')
+        self.assertEqual(self.fragments.stats()['misses'], 4)
+        self.assertEqual(self.fragments.stats()['hits'], 2)
+
+    def test_model_update_and_delete_evict(self):
+        self.add_actors(2)
+        self.get('/actors')
+
+        with self.app.app_context():
+            actor = Actor.query.get(1)
+            actor.name = 'Renamed'
+            actor.update()
+            self.assertNotIn(('actors', 1), self.fragments)
+
+            Actor.query.get(2).delete()
+            self.assertNotIn(('actors', 2), self.fragments)
+
+        self.assertEqual(self.get('/actors')['actors'][0]['name'], 'Renamed')
+
+    def test_expanded_cast_follows_actor_changes(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        self.client().patch('/movies/1', json={'cast': [1]},
+                            headers=self.headers)
+        self.get('/movies?expand=cast')
+
+        self.client().patch('/actors/1', json={'age': 99},
+                            headers=self.headers)
+        data = self.get('/movies?expand=cast')
+
+        self.assertEqual(data['movies'][0]['cast'][0]['age'], 99)
+
+
+class SingleFlightTestCase(LocalAppTestCase):
+
+    def test_concurrent_reads_share_one_query(self):
+        self.add_movies(3)
+        self.app.extensions['response_cache'].enabled = False
+        flight = self.app.extensions['single_flight']
+        callers = 8
+        barrier = threading.Barrier(callers)
+        results = []
+
+        def is_page_query(statement):
+            return 'FROM movies' in statement and 'LIMIT' in statement
+
+        def hold(statement):
+            # Hold the leader's query open so every caller arrives meanwhile
+            if is_page_query(statement):
+                time.sleep(0.5)
+
+        def read():
+            barrier.wait()
+            res = self.app.test_client().get('/movies?limit=2',
+                                             headers=self.headers)
+            results.append((res.status_code, res.headers['X-Cache'],
+                            json.loads(res.data)))
+
+        with self.record_statements(hold) as statements:
+            threads = [threading.Thread(target=read) for number in
+                       range(callers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len([statement for statement in statements
+                              if is_page_query(statement)]), 1)
+        self.assertEqual(flight.stats()['leaders'], 1)
+        self.assertEqual(flight.stats()['coalesced'], callers - 1)
+        self.assertEqual(sorted(cache for status, cache, data in results),
+                         ['COALESCED'] * (callers - 1) + ['MISS'])
+        self.assertTrue(all(data == results[0][2]
+                            for status, cache, data in results))
+
+    def test_leader_errors_are_not_shared(self):
+        single_flight = self.app.extensions['single_flight']
+        started = threading.Event()
+        release = threading.Event()
+        outcomes = []
+
+        def failing():
+            started.set()
+            release.wait()
+            raise ValueError('leader failed')
+
+        def leader():
+            try:
+                single_flight.do('key', failing)
+            except ValueError:
+                outcomes.append('raised')
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+
+        follower = threading.Thread(target=lambda: outcomes.append(
+            single_flight.do('key', lambda: 'own result')))
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        thread.join()
+        follower.join()
+
+        self.assertEqual(sorted(map(str, outcomes)),
+                         ["('own result', False)", 'raised'])
+
+
+class EngineProfileTestCase(LocalAppTestCase):
+
+    def pragma(self, app, name):
+        with app.app_context():
+            return db.session.execute('PRAGMA ' + name).scalar()
+
+    def test_sqlite_pragmas_applied(self):
+        self.assertEqual(self.pragma(self.app, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(self.app, 'synchronous'), 1)
+        self.assertEqual(self.pragma(self.app, 'busy_timeout'), 5000)
+        self.assertEqual(self.pragma(self.app, 'foreign_keys'), 1)
+
+    def test_default_profile_untouched(self):
+        db_fd, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                          'DB_PROFILE': 'default', 'DB_CREATE_ALL': True})
+
+        try:
+            self.assertEqual(self.pragma(app, 'journal_mode'), 'delete')
+        finally:
+            with app.app_context():
+                db.get_engine(app).dispose()
+            os.remove(db_file)
+
+    def test_postgres_options(self):
+        options = models.engine_options('postgresql://user@host/casting')
+
+        self.assertEqual(options['pool_size'], models.DB_POOL_SIZE)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIn('statement_timeout',
+                      options['connect_args']['options'])
+        self.assertEqual(models.engine_options('sqlite://'), {})
+
+
+class StartupTestCase(unittest.TestCase):
+    # Importing the app runs in a fresh interpreter to see the real cost
+
+    def import_app(self, database_file):
+        script = ('import sys, time\n'
+                  'started = time.perf_counter()\n'
+                  'import app\n'
+                  'print(time.perf_counter() - started)\n'
+                  'print("jose" in sys.modules)\n')
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + database_file)
+        env.pop('DB_CREATE_ALL', None)
+
+        output = subprocess.run(
+            [sys.executable, '-c', script], env=env, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+
+        return float(output[0]), output[1] == 'True'
+
+    def test_import_is_lazy(self):
+        database_dir = tempfile.mkdtemp()
+        database_file = os.path.join(database_dir, 'startup.db')
+
+        try:
+            seconds, jose_loaded = self.import_app(database_file)
+
+            # Nothing connected to the database or loaded the JWT stack
+            self.assertFalse(os.path.exists(database_file))
+            self.assertFalse(jose_loaded)
+            self.assertLess(seconds, 3)
+        finally:
+            for name in os.listdir(database_dir):
+                os.remove(os.path.join(database_dir, name))
+            os.rmdir(database_dir)
+
+    def test_create_all_opt_in(self):
+        db_fd, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+
+        try:
+            for create_all, expected in ((False, []), (True, ['actors'])):
+                app = create_app({
+                    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                    'DB_CREATE_ALL': create_all})
+
+                with app.app_context():
+                    tables = sqlalchemy.inspect(db.get_engine(app)) \
+                        .get_table_names()
+                    self.assertEqual(
+                        [name for name in tables if name == 'actors'],
+                        expected)
+                    db.get_engine(app).dispose()
+        finally:
+            os.remove(db_file)
+
+
+class MigrationTestCase(unittest.TestCase):
+    # Migrations run through manage.py against a throwaway SQLite file
+
+    def setUp(self):
+        db_fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+        os.remove(self.db_file)
+
+    def tearDown(self):
+        if os.path.exists(self.db_file):
+            os.remove(self.db_file)
+
+    def migrate(self, *args):
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + self.db_file)
+        env.pop('DB_CREATE_ALL', None)
+
+        subprocess.run(
+            [sys.executable, 'manage.py', 'db'] + list(args), env=env,
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_delta_sync_downgrade_keeps_search_triggers(self):
+        self.migrate('upgrade')
+        self.migrate('downgrade', 'f2a6c8d94b17')
+
+        connection = sqlite3.connect(self.db_file)
+
+        try:
+            triggers = {row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+            self.assertEqual(triggers, {
+                '{}_fts_{}'.format(table, action)
+                for table in ('actors', 'movies')
+                for action in ('insert', 'update', 'delete')})
+
+            # Rows written after the downgrade are still searchable
+            connection.execute("INSERT INTO actors (name, age, gender) "
+                               "VALUES ('Zelda Quill', 40, 'Female')")
+            connection.execute("INSERT INTO movies (title, release_date) "
+                               "VALUES ('Quiet Harbor', '2001-01-01')")
+            connection.commit()
+
+            self.assertEqual(connection.execute(
+                "SELECT rowid FROM actors_fts WHERE actors_fts MATCH 'quill'")
+                .fetchall(), [(1,)])
+            self.assertEqual(connection.execute(
+                "SELECT rowid FROM movies_fts WHERE movies_fts MATCH "
+                "'harbor'").fetchall(), [(1,)])
+        finally:
+            connection.close()
+
+
+class GunicornConfigTestCase(LocalAppTestCase):
+
+    def load_config(self, **env):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'gunicorn.conf.py')
+
+        with unittest.mock.patch.dict(os.environ, env):
+            return runpy.run_path(path)
+
+    def test_worker_modes(self):
+        config = self.load_config(GUNICORN_WORKER_MODE='threaded',
+                                  GUNICORN_THREADS='8', WEB_CONCURRENCY='3')
+        self.assertEqual(config['worker_class'], 'gthread')
+        self.assertEqual(config['threads'], 8)
+        self.assertEqual(config['workers'], 3)
+        self.assertTrue(config['preload_app'])
+
+        config = self.load_config(GUNICORN_WORKER_MODE='sync')
+        self.assertEqual(config['worker_class'], 'sync')
+        self.assertEqual(config['threads'], 1)
+
+        with self.assertRaises(ValueError):
+            self.load_config(GUNICORN_WORKER_MODE='eventlet')
+
+    def test_post_fork_disposes_engine(self):
+        config = self.load_config(GUNICORN_WORKER_MODE='sync')
+        server = unittest.mock.Mock()
+        server.cfg.preload_app = True
+        server.app.wsgi.return_value = self.app
+
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+            engine.execute('SELECT 1')
+            pool = engine.pool
+            self.assertEqual(pool.checkedin(), 1)
+
+            config['post_fork'](server, None)
+
+            # The inherited pool is closed and replaced by an empty one
+            self.assertIsNot(engine.pool, pool)
+            self.assertEqual(pool.checkedin(), 0)
+
+
+class ReadReplicaTestCase(LocalAppTestCase):
+    # A second SQLite file stands in for a replica that has not caught up
+
+    def setUp(self):
+        auth.jwks_cache.load(test_jwks)
+        db_fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+        db_fd, self.replica_file = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+
+        replica = sqlalchemy.create_engine('sqlite:///' + self.replica_file)
+        db.metadata.create_all(replica)
+        replica.execute(models.Actor.__table__.insert(), name='Replica',
+                        age=50, gender='Male')
+        replica.dispose()
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_file,
+            'SQLALCHEMY_REPLICA_URIS': ['sqlite:///' + self.replica_file],
+            'DB_CREATE_ALL': True
+        })
+        self.router = self.app.extensions['read_router']
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer ' + make_token([
+            'get:actors', 'get:movies', 'post:actors', 'post:movies'])}
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            models.dispose_engines(self.app)
+        os.remove(self.db_file)
+        os.remove(self.replica_file)
+
+    def actor_names(self, client):
+        res = client.get('/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_use_replica(self):
+        self.assertEqual(self.actor_names(self.client()), ['Replica'])
+        self.assertEqual(self.router.stats()['replica_reads'], 1)
+
+    def test_writer_pinned_to_primary(self):
+        client = self.client()
+        res = client.post('/actors', headers=self.headers, json={
+            'name': 'Primary', 'age': 30, 'gender': 'Female'})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('db_primary_until', res.headers['Set-Cookie'])
+
+        # Pinned by the cookie, and by token subject without it
+        self.assertEqual(self.actor_names(client), ['Primary'])
+        self.assertEqual(self.actor_names(self.client(use_cookies=False)),
+                         ['Primary'])
+
+    def test_pin_expires(self):
+        self.router.window = 0
+        self.client().post('/actors', headers=self.headers, json={
+            'name': 'Primary', 'age': 30, 'gender': 'Female'})
+
+        self.assertEqual(self.actor_names(self.client()), ['Replica'])
+
+    def test_round_robin(self):
+        router = replicas.ReadRouter(['first', 'second'])
+
+        self.assertEqual([router.choose() for number in range(4)],
+                         ['first', 'second', 'first', 'second'])
+
+
+class ShardingTestCase(LocalAppTestCase):
+    # Three SQLite files hold the actors and movies; the primary keeps ids
+
+    def setUp(self):
+        auth.jwks_cache.load(test_jwks)
+        self.files = []
+        for number in range(4):
+            db_fd, db_file = tempfile.mkstemp(suffix='.db')
+            os.close(db_fd)
+            self.files.append(db_file)
+
+        self.db_file = self.files[0]
+        self.config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_file,
+            'SQLALCHEMY_SHARD_URIS': ['sqlite:///' + db_file
+                                      for db_file in self.files[1:]],
+            'ID_BLOCK_SIZE': 4,
+            'DB_CREATE_ALL': True
+        }
+        self.apps = [create_app(self.config)]
+        self.app = self.apps[0]
+        self.shards = self.app.extensions['shards']
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer ' + make_token([
+            'get:actors', 'get:movies', 'post:actors', 'post:movies',
+            'patch:actors', 'patch:movies', 'delete:actors',
+            'delete:movies'])}
+
+    def tearDown(self):
+        for app in self.apps:
+            with app.app_context():
+                db.session.remove()
+                models.dispose_engines(app)
+        for db_file in self.files:
+            os.remove(db_file)
+
+    def shard_counts(self, table):
+        return [engine.execute('SELECT COUNT(*) FROM ' + table).scalar()
+                for engine in self.shards.engines]
+
+    def test_rows_spread_by_id(self):
+        self.add_actors(12)
+
+        counts = self.shard_counts('actors')
+        self.assertEqual(sum(counts), 12)
+        self.assertTrue(all(counts))
+
+        # Nothing is written to the primary's copy of the table
+        with self.app.app_context():
+            self.assertEqual(db.get_engine(self.app).execute(
+                'SELECT COUNT(*) FROM actors').scalar(), 0)
+
+    def test_pages_merge_in_order(self):
+        self.add_actors(9)
+
+        for sort, key in (('id', lambda actor: actor['id']),
+                          ('-age', lambda actor: -actor['age'])):
+            actors, cursor = [], None
+            while True:
+                url = '/actors?limit=2&sort=' + sort + \
+                    ('&cursor=' + cursor if cursor else '')
+                data = json.loads(self.client().get(
+                    url, headers=self.headers).data)
+                actors += data['actors']
+                cursor = data['next_cursor']
+                if cursor is None:
+                    break
+
+            self.assertEqual(len(actors), 9)
+            self.assertEqual(actors, sorted(actors, key=key))
+            self.assertEqual(data['actor_count'], 9)
+
+    def test_ids_unique_and_skip_explicit(self):
+        # Blocks of 4: six actors leave ids 7 and 8 reserved in-process
+        self.add_actors(6)
+
+        for chosen in (7, 50):
+            res = self.client().post('/actors/{}'.format(chosen),
+                                     headers=self.headers, json={
+                                         'name': 'Chosen', 'age': 40,
+                                         'gender': 'Male'})
+            self.assertTrue(json.loads(res.data)['success'])
+
+        # Both the reserved block and the sequence moved past the chosen ids
+        res = self.client().post('/actors', headers=self.headers, json={
+            'name': 'Next', 'age': 40, 'gender': 'Male'})
+        self.assertGreater(json.loads(res.data)['actor_id'], 50)
+
+        # A chosen id that exists is found on its shard
+        res = self.client().post('/actors/50', headers=self.headers, json={
+            'name': 'Again', 'age': 40, 'gender': 'Male'})
+        self.assertEqual(json.loads(res.data)['actor_name'], 'Chosen')
+        self.assertEqual(sum(self.shard_counts('actors')), 9)
+
+    def test_ids_taken_in_another_workers_block(self):
+        # A second app is a second worker with an allocator of its own
+        other = create_app(self.config)
+        self.apps.append(other)
+
+        def create(app, path='/actors'):
+            res = app.test_client().post(path, headers=self.headers, json={
+                'name': 'Actor', 'age': 40, 'gender': 'Male'})
+            self.assertEqual(res.status_code, 200)
+            return json.loads(res.data)['actor_id']
+
+        # This worker holds 1..4, so the other one cannot move past 3 or 4
+        self.assertEqual(create(self.app), 1)
+        self.assertEqual(create(other, '/actors/3'), 3)
+        self.assertEqual(create(other, '/actors/4'), 4)
+
+        self.assertEqual([create(self.app) for number in range(3)],
+                         [2, 5, 6])
+
+        # A bulk chunk holding a taken id is retried with fresh ids
+        self.assertEqual(create(other, '/actors/7'), 7)
+        res = self.client().post('/actors/bulk', headers=self.headers,
+                                 json=[{'name': 'Bulk', 'age': 40,
+                                        'gender': 'Male'}] * 2)
+        data = json.loads(res.data)
+        self.assertEqual(data['created'], 2)
+        self.assertNotIn(7, [result['actor_id']
+                             for result in data['results']])
+        self.assertEqual(sum(self.shard_counts('actors')), 9)
+
+    def test_cast_across_shards(self):
+        self.add_actors(6)
+        self.add_movies(1)
+        movie_id = json.loads(self.client().get(
+            '/movies', headers=self.headers).data)['movies'][0]['id']
+        actor_ids = [actor['id'] for actor in json.loads(self.client().get(
+            '/actors', headers=self.headers).data)['actors']]
+
+        res = self.client().patch('/movies/{}'.format(movie_id),
+                                  headers=self.headers,
+                                  json={'cast': actor_ids})
+        self.assertEqual(res.status_code, 200)
+
+        data = json.loads(self.client().get(
+            '/movies/{}?expand=cast'.format(movie_id),
+            headers=self.headers).data)
+        self.assertEqual([actor['id'] for actor in data['movie']['cast']],
+                         actor_ids)
+
+        res = self.client().get('/actors/{}/movies'.format(actor_ids[-1]),
+                                headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movie_count'], 1)
+
+        # Deleting an actor drops it from casts on other shards
+        self.client().delete('/actors/{}'.format(actor_ids[0]),
+                             headers=self.headers)
+        data = json.loads(self.client().get(
+            '/movies?expand=cast', headers=self.headers).data)
+        self.assertEqual([actor['id'] for actor in
+                          data['movies'][0]['cast']], actor_ids[1:])
+
+    def test_bulk_insert_and_search(self):
+        res = self.client().post('/actors/bulk', headers=self.headers, json=[
+            {'name': 'Bulk Actor {}'.format(number), 'age': 30,
+             'gender': 'Female'} for number in range(10)])
+        self.assertEqual(json.loads(res.data)['created'], 10)
+        self.assertEqual(sum(self.shard_counts('actors')), 10)
+
+        data = json.loads(self.client().get(
+            '/actors/search?q=bulk&limit=20', headers=self.headers).data)
+        self.assertEqual(len(data['actors']), 10)
+
+    def test_stream_merges_shards(self):
+        self.add_movies(7)
+
+        res = self.client().get('/movies?stream=1', headers=self.headers)
+        ids = [json.loads(line)['id'] for line in res.data.splitlines()]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), 7)
+
+    def test_shard_index_stable(self):
+        self.assertEqual([sharding.shard_index(row_id, 3)
+                          for row_id in range(1, 7)],
+                         [sharding.shard_index(row_id, 3)
+                          for row_id in range(1, 7)])
+        self.assertEqual(len({sharding.shard_index(row_id, 3)
+                              for row_id in range(1, 100)}), 3)
+
+
 if __name__ == "__main__":
     unittest.main()